@@ -0,0 +1,142 @@
+import functools
+import json
+import math
+import threading
+
+from geoHiPeep import EARTH_RADIUS_KM
+
+GRID_CELL_DEGREES = 0.5  # Size of one grid bucket in degrees of latitude/longitude
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180  # One degree of latitude on the sphere the distances use
+BOX_MARGIN = 1.01  # Bounding boxes are grown by 1%, so the grid never misses an ad the radius check accepts
+MAX_CELLS_PER_AD = 4096  # Ads covering more buckets than this are kept in the global bucket
+
+
+def parse_center(center):
+    """
+    Parses an adOrders 'center' string such as '17.3840, 78.4564' into a (lat, lon) tuple.
+    """
+    return tuple(map(float, center.split(',')))
+
+
+def parse_time_frames(row):
+    """
+    Parses the JSON time frame columns of an adOrders row into the dictionary
+    format used by is_within_valid_time_frames. Rows with the same time frames share
+    the returned dictionary, which must not be modified.
+    """
+    return _parse_time_frames(row['fromDates'], row['fromTimes'], row['toDates'], row['toTimes'])
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_time_frames(fromDates, fromTimes, toDates, toTimes):
+    return {'fromDates': json.loads(fromDates),
+            'fromTimes': json.loads(fromTimes),
+            'toDates': json.loads(toDates),
+            'toTimes': json.loads(toTimes)}
+
+
+class AdSpatialIndex:
+    """
+    Grid bucket index of active ad campaigns keyed on their parsed center and radius.
+
+    Every ad is registered in each grid cell its circle's bounding box overlaps, so a
+    lookup for a car location only has to look at the ads stored in the location's cell.
+    Candidates are returned in adId order, the same order the adOrders table is scanned in.
+    """
+
+    def __init__(self, cell_degrees=GRID_CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self._lon_cells = max(int(round(360 / cell_degrees)), 1)  # Longitude cells wrap around at 180 degrees
+        self._cells = {}  # (lat cell, lon cell) -> set of adIds
+        self._global = set()  # adIds whose radius is too large to bucket
+        self._entries = {}  # adId -> parsed ad entry
+        self._ad_cells = {}  # adId -> list of cells the ad is registered in
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, adId):
+        return int(adId) in self._entries
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_degrees)), int(math.floor(lon / self.cell_degrees)) % self._lon_cells
+
+    def _cells_for(self, center, radius):
+        lat, lon = center
+        radius *= BOX_MARGIN
+        dlat = radius / KM_PER_DEGREE
+        cos_lat = math.cos(math.radians(min(abs(lat) + dlat, 90.0)))
+        if cos_lat <= 1e-6:
+            return None
+        dlon = radius / (KM_PER_DEGREE * cos_lat)
+        if dlon >= 180:
+            return None
+
+        lat_lo, lat_hi = (int(math.floor(value / self.cell_degrees)) for value in (lat - dlat, lat + dlat))
+        lon_lo, lon_hi = (int(math.floor(value / self.cell_degrees)) for value in (lon - dlon, lon + dlon))
+        lon_hi = min(lon_hi, lon_lo + self._lon_cells - 1)
+        if (lat_hi - lat_lo + 1) * (lon_hi - lon_lo + 1) > MAX_CELLS_PER_AD:
+            return None
+        # Boxes crossing the 180th meridian continue in the cells on the other side
+        return [(i, j % self._lon_cells) for i in range(lat_lo, lat_hi + 1) for j in range(lon_lo, lon_hi + 1)]
+
+    def add(self, row):
+        """
+        Adds or replaces an adOrders row in the index.
+
+        Returns:
+            The parsed entry, or None if the row's center/radius/time frames could not be parsed.
+        """
+        try:
+            entry = {'row': dict(row),
+                     'center': parse_center(row['center']),
+                     'radius': float(row['radius']),
+                     'timeFrames': parse_time_frames(row)}
+        except (TypeError, ValueError, AttributeError) as e:
+            print(f"Error indexing ad {row.get('adId')}: {e}")
+            self.remove(row.get('adId'))
+            return None
+
+        adId = int(row['adId'])
+        cells = self._cells_for(entry['center'], entry['radius'])
+        with self._lock:
+            self._remove_locked(adId)
+            self._entries[adId] = entry
+            if cells is None:
+                self._global.add(adId)
+            else:
+                for cell in cells:
+                    self._cells.setdefault(cell, set()).add(adId)
+            self._ad_cells[adId] = cells
+        return entry
+
+    def remove(self, adId):
+        if adId is None:
+            return
+        with self._lock:
+            self._remove_locked(int(adId))
+
+    def _remove_locked(self, adId):
+        self._entries.pop(adId, None)
+        cells = self._ad_cells.pop(adId, None)
+        self._global.discard(adId)
+        for cell in cells or ():
+            bucket = self._cells.get(cell)
+            if bucket is not None:
+                bucket.discard(adId)
+                if not bucket:
+                    del self._cells[cell]
+
+    def get(self, adId):
+        return self._entries.get(int(adId))
+
+    def candidates(self, location):
+        """
+        Returns the entries of the ads whose bounding box covers the given (lat, lon) location.
+        The caller still has to do the exact radius check.
+        """
+        lat, lon = map(float, location)
+        with self._lock:
+            adIds = self._cells.get(self._cell(lat, lon), set()) | self._global
+            return [self._entries[adId] for adId in sorted(adIds)]
@@ -0,0 +1,147 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+ARTIFACT_FOLDER = 'artifactCache/'
+MAX_ARTIFACT_BYTES = 1024 * 1024 * 1024  # Disk used by cached plots and PDFs before evicting
+
+
+def _feed(digest, value):
+    if isinstance(value, np.ndarray):
+        digest.update(f'ndarray{value.dtype.str}{value.shape}'.encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        digest.update(f'dict{len(value)}'.encode())
+        for key in sorted(value, key=repr):
+            _feed(digest, key)
+            _feed(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'{type(value).__name__}{len(value)}'.encode())
+        for item in value:
+            _feed(digest, item)
+    else:
+        digest.update(f'{type(value).__name__}:{value!r};'.encode())
+
+
+def artifact_key(*parts):
+    """
+    Content hash of the given parts (numbers, strings, lists, dicts and numpy arrays).
+    Equal inputs always give the same key, in any process.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        _feed(digest, part)
+    return digest.hexdigest()
+
+
+def file_digest(filepath):
+    """
+    sha256 of a file's content, so artifacts depending on an image change when it does.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactCache:
+    """
+    Persistent, content-addressed store of rendered files (route plots, report PDFs).
+
+    Artifacts are written under their key, so an artifact is only ever rendered once for
+    the same input. Files are written to a temporary name and renamed into place, which
+    makes the cache safe to share between the report worker processes. When the folder
+    grows past max_bytes the least recently used artifacts are deleted.
+    """
+
+    def __init__(self, folder=ARTIFACT_FOLDER, max_bytes=MAX_ARTIFACT_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._size = None  # Bytes on disk, measured on first write
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def path_for(self, key, extension):
+        return os.path.join(self.folder, key[:2], f'{key}.{extension}')
+
+    def get(self, key, extension):
+        """
+        Returns the path of a cached artifact, or None if it isn't cached.
+        """
+        path = self.path_for(key, extension)
+        try:
+            os.utime(path)  # Mark as recently used for eviction
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get_or_create(self, key, extension, render):
+        """
+        Returns the path of the artifact with the given key, calling render(path) to
+        write it to a temporary path first if it isn't cached yet.
+        """
+        path = self.get(key, extension)
+        if path is not None:
+            self.hits += 1
+            return path
+
+        self.misses += 1
+        path = self.path_for(key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=f'.{extension}', dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            render(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self._added(os.path.getsize(path))
+        return path
+
+    def _scan(self):
+        files = []
+        for root, _, names in os.walk(self.folder):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _added(self, size):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._scan())
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self._evict_locked()
+
+    def _evict_locked(self):
+        files = sorted(self._scan())
+        self._size = sum(size for _, size, _ in files)
+        target = self.max_bytes * 0.9  # Leave some headroom so eviction doesn't run on every write
+        for _, size, path in files:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'bytes': self._size, 'max_bytes': self.max_bytes}
+
+
+artifacts = ArtifactCache()
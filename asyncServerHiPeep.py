@@ -0,0 +1,187 @@
+import asyncio
+import concurrent.futures
+import json
+import os
+import tempfile
+
+from aiohttp import web
+
+from metricsHiPeep import metrics
+from pollingHiPeep import (CREATIVE_MAX_AGE, UPLOAD_CHUNK, UPLOAD_FOLDER, creatives, handle_poll, metrics_snapshot,
+                           profiler_command, save_ad_order, save_ad_orders_bulk, start_services)
+
+SERVER_HOST = '0.0.0.0'
+SERVER_PORT = 5004
+DB_WORKERS = 8  # Threads doing the SQLite / index work of the polls, each keeps its pooled connection
+KEEPALIVE_TIMEOUT = 75  # Seconds an idle car connection is kept open for its next poll
+
+routes = web.RouteTableDef()
+
+
+async def in_worker(request, function, *args):
+    """
+    Runs blocking work (SQLite, file reads) on the bounded worker pool, off the event loop.
+    """
+    return await asyncio.get_running_loop().run_in_executor(request.app['workers'], function, *args)
+
+
+@routes.post('/endpoint')
+async def handle_request(request):
+    """
+    asyncio version of serverHiPeep's /endpoint, with the same request and response.
+    """
+    form = await request.post()
+    file = form.get('file')
+    if not isinstance(file, web.FileField):
+        return web.json_response({"error": "No file part in the request"}, status=400)
+
+    if file.content_type != 'application/json':
+        return web.json_response({"error": "Uploaded file is not a JSON file"}, status=400)
+
+    try:
+        with metrics.span('endpoint.parse'):
+            json_data = json.loads(file.file.read().decode('utf-8'))
+        print("Received Client JSON data :", json_data['adId'])
+    except json.JSONDecodeError:
+        return web.json_response({"error": "Invalid JSON file"}, status=400)
+
+    with metrics.span('endpoint.handle_poll'):
+        response = await in_worker(request, handle_poll, json_data)
+    with metrics.span('endpoint.serialize'):
+        return web.json_response(response)
+
+
+def _write_chunk(file, chunk):
+    file.write(chunk)
+
+
+@routes.post('/submit')
+async def preview(request):
+    """
+    asyncio version of serverHiPeep's /submit. The creative is streamed to disk in
+    UPLOAD_CHUNK pieces instead of being buffered in memory, and only replaces an
+    existing file of the same name once it is complete.
+    """
+    reader = await request.multipart()
+    form = {}
+    file_path = None
+    while (part := await reader.next()) is not None:
+        if part.name == 'adName' and part.filename:
+            file_path = os.path.join(UPLOAD_FOLDER, os.path.basename(part.filename))
+            file = await in_worker(request, open, file_path + '.part', 'wb')
+            try:
+                while chunk := await part.read_chunk(UPLOAD_CHUNK):
+                    await in_worker(request, _write_chunk, file, chunk)
+            finally:
+                await in_worker(request, file.close)
+            await in_worker(request, os.replace, file_path + '.part', file_path)
+        elif part.name is not None:
+            form[part.name] = await part.text()
+
+    if file_path is None:
+        return web.Response(text='No file uploaded')
+
+    with metrics.span('submit.save_order'):
+        await in_worker(request, save_ad_order, form, file_path)
+    return web.Response(text='success')
+
+
+@routes.post('/submit/bulk')
+async def bulk_submit(request):
+    """
+    asyncio version of serverHiPeep's /submit/bulk. The creatives archive is streamed
+    to a temporary file instead of being buffered in memory.
+    """
+    reader = await request.multipart()
+    orders, filename, archive = None, '', None
+    try:
+        while (part := await reader.next()) is not None:
+            if part.name == 'orders':
+                filename = part.filename or ''
+                orders = await part.read()
+            elif part.name == 'creatives':
+                archive = await in_worker(request, tempfile.TemporaryFile)
+                while chunk := await part.read_chunk(UPLOAD_CHUNK):
+                    await in_worker(request, _write_chunk, archive, chunk)
+
+        if orders is None:
+            return web.json_response({"error": "No orders file in the request"}, status=400)
+        return web.json_response(await in_worker(request, save_ad_orders_bulk, bytes(orders), filename, archive))
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+    finally:
+        if archive is not None:
+            archive.close()
+
+
+@routes.get('/creative/{etag}')
+async def creative(request):
+    """
+    asyncio version of serverHiPeep's /creative, with If-None-Match and Range support.
+    """
+    etag = request.match_info['etag']
+    entry = await in_worker(request, creatives.get_by_etag, etag)
+    if entry is None:
+        return web.json_response({"error": "Unknown creative"}, status=404)
+
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': f'public, max-age={CREATIVE_MAX_AGE}',
+               'Accept-Ranges': 'bytes'}
+    if_none_match = request.headers.get('If-None-Match', '')
+    if etag in [tag.strip().strip('"') for tag in if_none_match.split(',')] or if_none_match.strip() == '*':
+        return web.Response(status=304, headers=headers)
+
+    data = entry['data']
+    try:
+        byte_range = request.http_range
+    except ValueError:
+        return web.Response(status=416, headers={'Content-Range': f'bytes */{len(data)}'})
+    if byte_range.start is not None or byte_range.stop is not None:
+        start, stop, _ = byte_range.indices(len(data))
+        if start >= stop:
+            return web.Response(status=416, headers={'Content-Range': f'bytes */{len(data)}'})
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{len(data)}'
+        return web.Response(status=206, body=data[start:stop], content_type='image/jpeg', headers=headers)
+
+    return web.Response(body=data, content_type='image/jpeg', headers=headers)
+
+
+@routes.get('/metrics')
+async def metrics_endpoint(request):
+    """
+    asyncio version of serverHiPeep's /metrics.
+    """
+    if request.query.get('format') == 'text':
+        return web.Response(text=metrics.render_text())
+    return web.json_response(await in_worker(request, metrics_snapshot))
+
+
+@routes.route('*', '/metrics/profiler')
+async def profiler_endpoint(request):
+    """
+    asyncio version of serverHiPeep's /metrics/profiler.
+    """
+    report = profiler_command(request.query.get('action', 'report'), request.query.get('interval'))
+    if report is None:
+        return web.json_response({"error": "Unknown profiler action"}, status=400)
+    return web.json_response(report)
+
+
+async def _start(app):
+    app['workers'] = concurrent.futures.ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='hiPeepDb')
+    await asyncio.get_running_loop().run_in_executor(app['workers'], start_services)
+
+
+async def _stop(app):
+    app['workers'].shutdown(wait=True)
+
+
+def create_app():
+    app = web.Application()
+    app.add_routes(routes)
+    app.on_startup.append(_start)
+    app.on_cleanup.append(_stop)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host=SERVER_HOST, port=SERVER_PORT, keepalive_timeout=KEEPALIVE_TIMEOUT)
@@ -0,0 +1,399 @@
+"""
+Load benchmark of the ad server with a simulated car fleet.
+
+Every scenario seeds a fresh mooh.db with synthetic adOrders and tracker histories in a
+temporary folder, then drives /endpoint of the Flask app (serverHiPeep) through its test
+client with the JSON files the cars post, and times ad report data reads. Scenarios run
+in their own process, so each one starts from a cold index and empty caches.
+
+    python benchHiPeep.py --ads 100 1000 --routes 1000 --cars 20 --polls 25
+    python benchHiPeep.py --seed-only benchData --ads 1000 --routes 5000
+    python benchHiPeep.py --url http://127.0.0.1:5004 --cars 20 --polls 25
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import urllib.request
+import uuid
+
+REPO_FOLDER = os.path.dirname(os.path.abspath(__file__))
+BASE_LOCATION = (17.3850, 78.4867)  # Hyderabad, where the real campaigns run
+SPREAD_DEGREES = 0.5  # Synthetic ad centers and cars stay within this many degrees of BASE_LOCATION
+STEP_DEGREES = 0.002  # Largest move of a simulated car between two location samples
+POINTS_PER_POLL = 60  # Locations a car reports per poll
+BENCH_IMAGE = 'Suits.jpg'  # Creative (from adFiles/) of every synthetic ad
+
+SEED_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS adOrders (
+            adId INTEGER PRIMARY KEY AUTOINCREMENT,
+            user TEXT,
+            center TEXT,
+            email TEXT,
+            fileUploaded TEXT,
+            fromDates TEXT,
+            fromTimes TEXT,
+            radius TEXT,
+            runTime TEXT,
+            toDates TEXT,
+            toTimes TEXT
+        )''',
+    '''CREATE TABLE IF NOT EXISTS trackerLog (
+            routeId INTEGER PRIMARY KEY AUTOINCREMENT,
+            carId INTEGER,
+            adId INTEGER,
+            locs TEXT,
+            times TEXT
+        )''',
+)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def latency_summary(latencies, seconds):
+    """
+    p50/p95/p99 latency (milliseconds) and requests/second of a timed phase.
+    """
+    return {'requests': len(latencies),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'mean_ms': round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+            'req_per_s': round(len(latencies) / seconds, 1) if seconds else 0.0}
+
+
+def random_location(rng):
+    return (BASE_LOCATION[0] + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES),
+            BASE_LOCATION[1] + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES))
+
+
+def random_walk(rng, start, points, start_time=None):
+    """
+    A car route of the given length, as the 'lat:lon*' and 'HH:MM:SS*' strings cars post.
+
+    Returns:
+        (locs, times, last location)
+    """
+    lat, lon = start
+    moment = start_time or datetime.datetime(2024, 1, 1, rng.randrange(6, 20), rng.randrange(60))
+    locs, times = [], []
+    for _ in range(points):
+        lat += rng.uniform(-STEP_DEGREES, STEP_DEGREES)
+        lon += rng.uniform(-STEP_DEGREES, STEP_DEGREES)
+        locs.append(f'{lat:.6f}:{lon:.6f}*')
+        times.append(f'{moment:%H:%M:%S}*')
+        moment += datetime.timedelta(seconds=30)
+    return ''.join(locs), ''.join(times), (lat, lon)
+
+
+def synthetic_ad(rng, index, today, image_path):
+    """
+    An adOrders row with a random center, radius and one to three time frames. About
+    half of the ads are live today.
+    """
+    center = random_location(rng)
+    fromDates, fromTimes, toDates, toTimes = [], [], [], []
+    for _ in range(rng.randint(1, 3)):
+        start = today + datetime.timedelta(days=rng.randint(-30, 10))
+        end = start + datetime.timedelta(days=rng.randint(0, 60))
+        opens = rng.randrange(0, 20)
+        fromDates.append(f'{start:%Y-%m-%d}')
+        toDates.append(f'{end:%Y-%m-%d}')
+        fromTimes.append(f'{opens:02d}:00')
+        toTimes.append(f'{rng.randrange(opens + 1, 24):02d}:{rng.choice((0, 30, 59)):02d}')
+    return (f'benchClient{index % 50}', f'{center[0]:.4f}, {center[1]:.4f}', f'bench{index}@example.com',
+            image_path, json.dumps(fromDates), json.dumps(fromTimes), str(rng.randint(1, 25)),
+            str(rng.randint(600, 36000)), json.dumps(toDates), json.dumps(toTimes))
+
+
+def seed_database(folder, ads, routes, cars, seed=0):
+    """
+    Creates mooh.db in folder with synthetic adOrders and tracker histories, next to
+    the creatives and memes the server needs.
+
+    Args:
+        folder: The working folder of the benchmarked server.
+        ads: Number of adOrders rows.
+        routes: Number of trackerLog routes, written through the batched ingest path.
+        cars: Number of distinct carIds the routes belong to.
+        seed: Seed of the random data, the same arguments always give the same database.
+
+    Returns:
+        The path of the seeded database.
+    """
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(folder, 'adFiles'), exist_ok=True)
+    image_path = os.path.join('adFiles', BENCH_IMAGE)
+    shutil.copy(os.path.join(REPO_FOLDER, image_path), os.path.join(folder, image_path))
+    memes = os.path.join(folder, 'memeFiles')
+    if not os.path.exists(memes):
+        shutil.copytree(os.path.join(REPO_FOLDER, 'memeFiles'), memes)
+
+    db_file = os.path.join(folder, 'mooh.db')
+    today = datetime.date.today()
+    with contextlib.closing(sqlite3.connect(db_file)) as conn:
+        with conn:
+            for statement in SEED_SCHEMA:
+                conn.execute(statement)
+            conn.executemany('''INSERT INTO adOrders (user, center, email, fileUploaded, fromDates, fromTimes,
+                                                      radius, runTime, toDates, toTimes)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                             [synthetic_ad(rng, index, today, image_path) for index in range(ads)])
+
+    from ingestHiPeep import TrackerIngestQueue
+
+    ingest = TrackerIngestQueue(db_file, flush_on_shutdown=True).start()
+    for _ in range(routes):
+        locs, times, _ = random_walk(rng, random_location(rng), rng.randint(20, 200))
+        ingest.submit_route(rng.randrange(1, cars + 1), rng.randint(1, max(ads, 1)), locs, times)
+    ingest.stop()
+    return db_file
+
+
+def database_size(db_file):
+    return sum(os.path.getsize(path) for path in (db_file, db_file + '-wal') if os.path.exists(path))
+
+
+class Car:
+    """
+    A simulated car: drives a random walk, posts it with the runTime it has left of
+    its last ad and shows whatever the server sends back.
+    """
+
+    def __init__(self, carId, rng):
+        self.carId = carId
+        self.rng = rng
+        self.location = random_location(rng)
+        self.adId = 0
+        self.runTime = 0
+
+    def payload(self, image_mode=None):
+        locs, times, self.location = random_walk(self.rng, self.location, POINTS_PER_POLL,
+                                                 datetime.datetime.now())
+        payload = {'adId': self.adId, 'carId': self.carId, 'runTime': self.runTime,
+                   'locs': locs, 'times': times, 'currentLocation': list(self.location)}
+        if image_mode:
+            payload['imageMode'] = image_mode
+        return payload
+
+    def shown(self, response):
+        self.adId = int(response.get('adId', 0))
+        # Part of an ad's runTime is still left when the next poll is due
+        self.runTime = int(response.get('runTime', 0) * self.rng.uniform(0, 0.5))
+
+
+def multipart_json(payload):
+    """
+    The multipart/form-data body of /endpoint: the payload as an application/json 'file' part.
+    """
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="car.json"\r\n'
+            f'Content-Type: application/json\r\n\r\n{json.dumps(payload)}\r\n--{boundary}--\r\n').encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def url_poster(url):
+    def post(payload):
+        body, content_type = multipart_json(payload)
+        request = urllib.request.Request(url.rstrip('/') + '/endpoint', data=body,
+                                         headers={'Content-Type': content_type})
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+    return post
+
+
+def test_client_poster(app):
+    client = app.test_client()
+
+    def post(payload):
+        body, content_type = multipart_json(payload)
+        response = client.post('/endpoint', data=body, content_type=content_type)
+        if response.status_code != 200:
+            raise RuntimeError(f'/endpoint answered {response.status_code}: {response.get_data(as_text=True)}')
+        return response.get_json()
+    return post
+
+
+def drive_fleet(post, cars, polls, concurrency, image_mode=None, seed=0):
+    """
+    Runs the simulated fleet against post(payload) -> response, with concurrency cars
+    polling at the same time.
+
+    Returns:
+        The latency summary of all polls and the number of polls answered with an ad.
+    """
+    fleet = [Car(carId, random.Random(seed * 100003 + carId)) for carId in range(1, cars + 1)]
+    latencies = []
+    ads_sent = 0
+
+    def run(car):
+        timings, hits = [], 0
+        for _ in range(polls):
+            payload = car.payload(image_mode)
+            started = time.perf_counter()
+            response = post(payload)
+            timings.append(time.perf_counter() - started)
+            car.shown(response)
+            hits += car.adId != 0
+        return timings, hits
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for timings, hits in pool.map(run, fleet):
+            latencies.extend(timings)
+            ads_sent += hits
+    summary = latency_summary(latencies, time.perf_counter() - started)
+    summary['ads_sent'] = ads_sent
+    return summary
+
+
+def time_reports(ad_ids, pdf=False):
+    """
+    Times reading the report data (routes, distances, runtimes) of each ad, and
+    optionally building its PDF.
+    """
+    from functionsHiPeep import ad_report_data, generate_report_for_adId
+
+    phases = {'report_data': []}
+    if pdf:
+        phases['report_pdf'] = []
+    for adId in ad_ids:
+        started = time.perf_counter()
+        ad_report_data(adId)
+        phases['report_data'].append(time.perf_counter() - started)
+        if pdf:
+            started = time.perf_counter()
+            generate_report_for_adId(adId, f'bench_ad_{adId}.pdf')
+            phases['report_pdf'].append(time.perf_counter() - started)
+    return {name: latency_summary(latencies, sum(latencies)) for name, latencies in phases.items()}
+
+
+def run_scenario(scenario):
+    """
+    Seeds a temporary folder and benchmarks it, in a fresh process.
+
+    Args:
+        scenario: A dictionary with ads, routes, cars, polls, concurrency, report_ads,
+            pdf, image_mode, seed and verbose.
+
+    Returns:
+        The scenario with its phase results and the database sizes.
+    """
+    folder = tempfile.mkdtemp(prefix='hiPeepBench')
+    try:
+        started = time.perf_counter()
+        db_file = seed_database(folder, scenario['ads'], scenario['routes'], scenario['cars'], scenario['seed'])
+        result = dict(scenario, seed_seconds=round(time.perf_counter() - started, 2),
+                      seed_db_bytes=database_size(db_file))
+
+        # The server resolves mooh.db, adFiles/ and memeFiles/ relative to its working folder
+        os.chdir(folder)
+        output = sys.stdout if scenario['verbose'] else open(os.devnull, 'w')
+        with contextlib.redirect_stdout(output):
+            import pollingHiPeep
+            from serverHiPeep import app
+
+            result['endpoint'] = drive_fleet(test_client_poster(app), scenario['cars'], scenario['polls'],
+                                             scenario['concurrency'], scenario['image_mode'], scenario['seed'])
+            started = time.perf_counter()
+            pollingHiPeep.budget.persist_now()
+            pollingHiPeep.tracker_ingest.flush()
+            result['ingest_flush_seconds'] = round(time.perf_counter() - started, 3)
+
+            with contextlib.closing(sqlite3.connect(db_file)) as conn:
+                ad_ids = [row[0] for row in conn.execute('''SELECT adId FROM trackerLog
+                                                            WHERE adId IN (SELECT adId FROM adOrders)
+                                                            GROUP BY adId ORDER BY COUNT(*) DESC LIMIT ?''',
+                                                         (scenario['report_ads'],))]
+            result.update(time_reports(ad_ids, scenario['pdf']))
+            pollingHiPeep.tracker_ingest.stop()
+        result['db_bytes'] = database_size(db_file)
+        return result
+    finally:
+        os.chdir(REPO_FOLDER)
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def print_results(results):
+    header = f"{'ads':>7} {'routes':>8} {'phase':<12} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8}"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        for phase in ('endpoint', 'report_data', 'report_pdf'):
+            if phase not in result:
+                continue
+            stats = result[phase]
+            print(f"{result['ads']:>7} {result['routes']:>8} {phase:<12} {stats['requests']:>6} {stats['p50_ms']:>9} "
+                  f"{stats['p95_ms']:>9} {stats['p99_ms']:>9} {stats['req_per_s']:>8}")
+        print(f"{'':>17} db {result['seed_db_bytes'] / 1e6:.2f} MB seeded -> {result['db_bytes'] / 1e6:.2f} MB, "
+              f"seeded in {result['seed_seconds']} s, ingest flush {result['ingest_flush_seconds']} s, "
+              f"{result['endpoint']['ads_sent']} ads sent")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--ads', type=int, nargs='+', default=[100, 1000], help='adOrders rows per scenario')
+    parser.add_argument('--routes', type=int, nargs='+', default=[1000], help='trackerLog routes per scenario')
+    parser.add_argument('--cars', type=int, default=20, help='simulated cars')
+    parser.add_argument('--polls', type=int, default=25, help='polls per car')
+    parser.add_argument('--concurrency', type=int, default=4, help='cars polling at the same time')
+    parser.add_argument('--report-ads', type=int, default=5, help='ads whose report data is timed')
+    parser.add_argument('--pdf', action='store_true', help='also time building the ad report PDFs')
+    parser.add_argument('--image-mode', choices=['ref'], help="poll with imageMode 'ref' instead of inline images")
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    parser.add_argument('--url', help='drive a running server at this URL instead of seeding scenarios')
+    parser.add_argument('--seed-only', metavar='FOLDER', help='seed FOLDER (first --ads/--routes) and exit')
+    parser.add_argument('--verbose', action='store_true', help="keep the server's own prints")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.seed_only:
+        db_file = seed_database(args.seed_only, args.ads[0], args.routes[0], args.cars, args.seed)
+        print(f'seeded {db_file}: {database_size(db_file) / 1e6:.2f} MB')
+        return []
+
+    if args.url:
+        summary = drive_fleet(url_poster(args.url), args.cars, args.polls, args.concurrency, args.image_mode, args.seed)
+        print(json.dumps(summary, indent=2))
+        results = [dict(summary, url=args.url)]
+    else:
+        scenarios = [{'ads': ads, 'routes': routes, 'cars': args.cars, 'polls': args.polls,
+                      'concurrency': args.concurrency, 'report_ads': args.report_ads, 'pdf': args.pdf,
+                      'image_mode': args.image_mode, 'seed': args.seed, 'verbose': args.verbose}
+                     for ads, routes in itertools.product(args.ads, args.routes)]
+        results = []
+        # One fresh process per scenario, the server modules keep their state in globals
+        context = multiprocessing.get_context('spawn')
+        for scenario in scenarios:
+            with context.Pool(1) as pool:
+                results.append(pool.apply(run_scenario, (scenario,)))
+        print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
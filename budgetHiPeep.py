@@ -0,0 +1,164 @@
+import threading
+import time
+
+LEASE_SECONDS = 120  # Runtime handed to one car at a time
+LEASE_GRACE = 60  # Extra time a car gets to report back before its lease is reclaimed
+PERSIST_INTERVAL = 5.0  # Seconds between writes of the changed budgets
+
+
+def _seconds(runTime):
+    try:
+        return max(int(float(runTime)), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class BudgetEngine:
+    """
+    In-memory runTime accounting of the ads, shared by every car.
+
+    Instead of handing an ad's whole runTime to the first car and zeroing it, cars
+    reserve() leases of at most lease_seconds. When the car reports back with the
+    runTime it has left, settle() returns the unused part to the ad. Leases a car never
+    reports back on are reclaimed once they expire. All counters change under one lock,
+    so concurrent polls never lose an update.
+
+    The budgets live in memory and are written back every persist_interval seconds
+    through the persist(adId, runTime) callback. The persisted runTime counts the
+    outstanding leases as unspent, so a restart never loses budget.
+    """
+
+    def __init__(self, persist=None, lease_seconds=LEASE_SECONDS, lease_grace=LEASE_GRACE,
+                 persist_interval=PERSIST_INTERVAL):
+        self.persist = persist
+        self.lease_seconds = lease_seconds
+        self.lease_grace = lease_grace
+        self.persist_interval = persist_interval
+
+        self._remaining = {}  # adId -> seconds not leased to any car
+        self._leases = {}  # (adId, carId) -> (seconds, expires at)
+        self._leased = {}  # adId -> seconds out on leases
+        self._dirty = set()  # adIds whose budget changed since the last persist
+        self._lock = threading.Lock()
+        self._last_persist = time.monotonic()
+        self._stats = {'reserved': 0, 'settled': 0, 'reclaimed': 0, 'exhausted': 0}
+
+    def _ensure_locked(self, adId, runTime):
+        if adId not in self._remaining:
+            self._remaining[adId] = _seconds(runTime)
+            self._leased.setdefault(adId, 0)
+
+    def load(self, adId, runTime):
+        """
+        Sets an ad's budget from a freshly saved order. Outstanding leases are kept and
+        count against the new budget. The ad is marked changed, so the next persist
+        writes the new budget over any older runTime still queued for it.
+        """
+        adId = int(adId)
+        with self._lock:
+            self._remaining[adId] = max(_seconds(runTime) - self._leased.get(adId, 0), 0)
+            self._leased.setdefault(adId, 0)
+            self._dirty.add(adId)
+
+    def reserve(self, adId, carId, runTime):
+        """
+        Leases up to lease_seconds of an ad's budget to a car.
+
+        Args:
+            adId: The ad to run.
+            carId: The car that will show it.
+            runTime: The ad's stored runTime, only used the first time the ad is seen.
+
+        Returns:
+            The leased seconds, 0 if the ad has no budget left.
+        """
+        adId = int(adId)
+        now = time.monotonic()
+        with self._lock:
+            self._ensure_locked(adId, runTime)
+            self._release_locked(adId, carId, None)  # A car only ever holds one lease per ad
+            granted = min(self.lease_seconds, self._remaining[adId])
+            if granted <= 0:
+                self._stats['exhausted'] += 1
+                return 0
+            self._remaining[adId] -= granted
+            self._leased[adId] += granted
+            self._leases[(adId, carId)] = (granted, now + granted + self.lease_grace)
+            self._dirty.add(adId)
+            self._stats['reserved'] += 1
+            return granted
+
+    def settle(self, adId, carId, leftover):
+        """
+        Closes a car's lease with the runTime it reports as not shown, returning that
+        part to the ad. Reports for ads the car holds no lease on are ignored.
+
+        Returns:
+            The seconds the car used, or None if it held no lease.
+        """
+        adId = int(adId)
+        with self._lock:
+            lease = self._leases.get((adId, carId))
+            if lease is None:
+                return None
+            returned = min(_seconds(leftover), lease[0])
+            self._release_locked(adId, carId, returned)
+            self._stats['settled'] += 1
+            return lease[0] - returned
+
+    def _release_locked(self, adId, carId, returned):
+        lease = self._leases.pop((adId, carId), None)
+        if lease is None:
+            return
+        seconds = lease[0]
+        self._leased[adId] -= seconds
+        self._remaining[adId] += seconds if returned is None else returned
+        self._dirty.add(adId)
+
+    def reclaim_expired(self, now=None):
+        """
+        Returns the budget of every lease whose car didn't report back in time.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            expired = [key for key, (_, expires_at) in self._leases.items() if expires_at <= now]
+            for adId, carId in expired:
+                self._release_locked(adId, carId, None)
+            self._stats['reclaimed'] += len(expired)
+        return len(expired)
+
+    def available(self, adId):
+        with self._lock:
+            return self._remaining.get(int(adId))
+
+    def exhausted(self, adId):
+        """
+        True when the ad has neither budget left nor outstanding leases.
+        """
+        adId = int(adId)
+        with self._lock:
+            return self._remaining.get(adId) == 0 and self._leased.get(adId, 0) == 0
+
+    def tick(self):
+        """
+        Reclaims expired leases and persists the changed budgets once persist_interval
+        has passed. Cheap to call on every poll.
+        """
+        if time.monotonic() - self._last_persist >= self.persist_interval:
+            self.reclaim_expired()
+            self.persist_now()
+
+    def persist_now(self):
+        with self._lock:
+            self._last_persist = time.monotonic()
+            budgets = {adId: self._remaining[adId] + self._leased[adId] for adId in self._dirty}
+            self._dirty.clear()
+        if self.persist is not None:
+            for adId, runTime in budgets.items():
+                self.persist(adId, runTime)
+        return len(budgets)
+
+    def metrics(self):
+        with self._lock:
+            return dict(self._stats, ads=len(self._remaining), leases=len(self._leases),
+                        leased_seconds=sum(self._leased.values()), dirty=len(self._dirty))
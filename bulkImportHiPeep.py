@@ -0,0 +1,232 @@
+import csv
+import functools
+import io
+import json
+import os
+import shutil
+import tarfile
+import zipfile
+
+from adIndexHiPeep import parse_center
+from creativeCacheHiPeep import IMAGE_EXTENSIONS
+from functionsHiPeep import bulk_save_adOrders_to_db
+
+# Column of an order -> the /submit form field names and adOrders column names it may come as
+ORDER_FIELDS = {
+    'user': ('client', 'user'),
+    'fromDates': ('fromDate', 'fromDates'),
+    'fromTimes': ('fromTime', 'fromTimes'),
+    'toDates': ('toDate', 'toDates'),
+    'toTimes': ('toTime', 'toTimes'),
+    'center': ('center',),
+    'radius': ('radius',),
+    'runTime': ('run_time', 'runTime'),
+    'email': ('email',),
+    'fileUploaded': ('file', 'adName', 'fileUploaded'),
+}
+LIST_FIELDS = ('fromDates', 'fromTimes', 'toDates', 'toTimes')
+COPY_CHUNK = 64 * 1024  # Bytes of a creative copied out of the archive at a time
+
+
+def read_records(data, filename=''):
+    """
+    Reads the orders of a CSV file (with a header row) or a JSONL file (one JSON object
+    per line), by the file's extension, or its first character when there is none.
+
+    Returns:
+        A list of (record, error) tuples, error being None when the line could be read.
+    """
+    text = data.decode('utf-8-sig') if isinstance(data, bytes) else data
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in ('.jsonl', '.json', '.ndjson') or (not extension and text.lstrip().startswith('{')):
+        records = []
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                records.append((record, None) if isinstance(record, dict) else ({}, 'line is not a JSON object'))
+            except json.JSONDecodeError as e:
+                records.append(({}, f'invalid JSON: {e}'))
+        return records
+    return [(record, None) for record in csv.DictReader(io.StringIO(text))]
+
+
+def _field(record, name):
+    for alias in ORDER_FIELDS[name]:
+        value = record.get(alias)
+        if value not in (None, ''):
+            return value
+    raise ValueError(f'missing {ORDER_FIELDS[name][0]}')
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_list(value):
+    # The form posts JSON lists, CSV cells may also hold 'a;b' or a single value
+    value = value.strip()
+    if value.startswith('['):
+        return tuple(json.loads(value))
+    return tuple(part.strip() for part in value.split(';') if part.strip())
+
+
+def _as_list(value):
+    if isinstance(value, list):
+        return value
+    return list(_parse_list(str(value)))
+
+
+def normalize_order(record, creatives_by_name, upload_folder, uploaded=None):
+    """
+    Turns one imported record into the dictionary save_adOrders_to_db takes.
+
+    Args:
+        record: The record as read from the CSV/JSONL file.
+        creatives_by_name: {file name: saved path} of the creatives extracted from the archive.
+        upload_folder: Where creatives uploaded earlier are looked for.
+        uploaded: Optional {file name: exists} memo of the upload folder lookups.
+
+    Raises:
+        ValueError: If a field is missing or malformed, or the creative is unknown.
+    """
+    order = {name: _field(record, name) for name in ORDER_FIELDS}
+    for name in LIST_FIELDS:
+        order[name] = _as_list(order[name])
+    if not order['fromDates'] or len({len(order[name]) for name in LIST_FIELDS}) != 1:
+        raise ValueError('fromDate, fromTime, toDate and toTime need the same, non zero, number of entries')
+
+    if isinstance(order['center'], (list, tuple)):
+        order['center'] = ', '.join(map(str, order['center']))
+    if len(parse_center(order['center'])) != 2:
+        raise ValueError('center must be "lat, lon"')
+    radius = float(order['radius'])
+    if not radius.is_integer():
+        raise ValueError('radius must be a whole number of km')  # Polls and reports read it with int()
+    order['radius'] = str(int(radius))
+    order['runTime'] = str(order['runTime'])
+    if float(order['runTime']) < 0 or radius <= 0:
+        raise ValueError('radius must be positive and run_time not negative')
+
+    name = os.path.basename(str(order['fileUploaded']))
+    if not name.lower().endswith(IMAGE_EXTENSIONS):
+        raise ValueError(f'creative {name} must be a {" or ".join(IMAGE_EXTENSIONS)} image')
+    if name in creatives_by_name:
+        order['fileUploaded'] = creatives_by_name[name]
+    elif _uploaded(upload_folder, name, {} if uploaded is None else uploaded):
+        order['fileUploaded'] = os.path.join(upload_folder, name)
+    else:
+        raise ValueError(f'creative {name} is neither in the archive nor uploaded')
+    order['user'] = str(order['user'])
+    order['email'] = str(order['email'])
+    return order
+
+
+def _uploaded(upload_folder, name, memo):
+    if name not in memo:
+        memo[name] = os.path.exists(os.path.join(upload_folder, name))
+    return memo[name]
+
+
+def extract_creatives(archive, upload_folder):
+    """
+    Streams the images of a zip or tar archive of creatives into the upload folder.
+    Folders inside the archive are ignored, creatives are stored by their file name. Only
+    the IMAGE_EXTENSIONS the creative cache serves are extracted.
+
+    Args:
+        archive: A path or binary file object of the archive.
+        upload_folder: The folder /submit saves creatives to.
+
+    Returns:
+        {file name: saved path}
+
+    Raises:
+        ValueError: If the archive is neither a zip nor a tar archive, or is corrupt.
+    """
+    try:
+        return _extract_creatives(archive, upload_folder)
+    except (tarfile.TarError, zipfile.BadZipFile) as e:
+        raise ValueError('creatives must be a zip or tar archive') from e
+
+
+def _extract_creatives(archive, upload_folder):
+    is_file = hasattr(archive, 'read')
+    if is_file:
+        archive.seek(0)
+    is_zip = zipfile.is_zipfile(archive)
+    if is_file:
+        archive.seek(0)
+
+    if is_zip:
+        with zipfile.ZipFile(archive) as bundle:
+            return _save_members([(member.filename, lambda member=member: bundle.open(member))
+                                  for member in bundle.infolist() if not member.is_dir()], upload_folder)
+    with tarfile.open(fileobj=archive) if is_file else tarfile.open(archive) as bundle:
+        return _save_members([(member.name, lambda member=member: bundle.extractfile(member))
+                              for member in bundle.getmembers() if member.isfile()], upload_folder)
+
+
+def _save_members(members, upload_folder):
+    saved = {}
+    for member_name, open_member in members:
+        name = os.path.basename(member_name)
+        if not name.lower().endswith(IMAGE_EXTENSIONS) or name.startswith('.'):
+            continue
+        file_path = os.path.join(upload_folder, name)
+        with open_member() as source, open(file_path, 'wb') as target:
+            shutil.copyfileobj(source, target, COPY_CHUNK)
+        saved[name] = file_path
+    return saved
+
+
+def prepare_orders(records, creatives_by_name, upload_folder):
+    """
+    Normalizes read records, keeping the ones that fail validation as per-row errors.
+
+    Returns:
+        (orders, results): the valid orders with their row numbers, and a result slot per
+        record, already filled in for the invalid ones.
+    """
+    orders, results = [], []
+    uploaded = {}  # Many orders share a creative, each file is looked up once
+    for row, (record, error) in enumerate(records, start=1):
+        if error is None:
+            try:
+                orders.append((row, normalize_order(record, creatives_by_name, upload_folder, uploaded)))
+                results.append(None)
+                continue
+            except (ValueError, TypeError, json.JSONDecodeError) as e:
+                error = str(e)
+        results.append({'row': row, 'status': 'error', 'error': error})
+    return orders, results
+
+
+def import_orders(data, filename, archive, upload_folder, on_saved=None):
+    """
+    Imports many ad orders (CSV or JSONL) and their creatives in one go.
+
+    Args:
+        data: The contents of the orders file.
+        filename: The orders file's name, its extension selects CSV or JSONL.
+        archive: A zip or tar archive (path or binary file object) of creatives, or None.
+        upload_folder: Where the creatives are saved.
+        on_saved: Called as on_saved(adId, order) for every order written to adOrders.
+
+    Returns:
+        A dictionary with the number of inserted, updated, superseded and failed orders,
+        the saved creatives and one result per row ({'row', 'status', 'adId' or 'error'}).
+
+    Raises:
+        ValueError: If the archive can't be read, no order is imported then.
+    """
+    creatives_by_name = extract_creatives(archive, upload_folder) if archive is not None else {}
+    orders, results = prepare_orders(read_records(data, filename), creatives_by_name, upload_folder)
+    saved = bulk_save_adOrders_to_db([order for _, order in orders]) if orders else []
+    for (row, order), (status, adId) in zip(orders, saved):
+        results[row - 1] = {'row': row, 'status': status, 'adId': adId}
+        if on_saved is not None and status != 'superseded':
+            on_saved(adId, order)
+
+    summary = {status: 0 for status in ('inserted', 'updated', 'superseded', 'error')}
+    for result in results:
+        summary[result['status']] += 1
+    return dict(summary, creatives=sorted(creatives_by_name.values()), results=results)
@@ -0,0 +1,126 @@
+import base64
+import collections
+import hashlib
+import os
+import threading
+
+MAX_CACHE_BYTES = 256 * 1024 * 1024  # Raw plus base64 bytes kept in memory before evicting
+IMAGE_EXTENSIONS = ('.jpg',)
+
+
+def cache_key(filepath):
+    return os.path.normcase(os.path.abspath(filepath))
+
+
+class CreativeCache:
+    """
+    Size-bounded LRU cache of creative images, holding each file's raw bytes, its
+    pre-encoded base64 string and a content hash, so polls never touch the disk for an
+    image that is already cached.
+
+    Entries are not re-checked against the disk on a hit, callers that replace a file
+    (such as /submit) have to invalidate() it.
+    """
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()  # key -> entry, least recently used first
+        self._listings = {}  # folder key -> list of image paths in it
+        self._etags = {}  # content hash -> path, kept after eviction so the hash can be served again
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _load(self, filepath):
+        with open(filepath, "rb") as img_file:
+            data = img_file.read()
+        encoded = base64.b64encode(data).decode('utf-8')
+        return {'path': filepath,
+                'data': data,
+                'base64': encoded,
+                'etag': hashlib.sha256(data).hexdigest(),
+                'size': len(data) + len(encoded)}
+
+    def get(self, filepath):
+        """
+        Returns the cache entry of an image, reading and encoding it on a miss.
+        Raises OSError if the file cannot be read, like open() would.
+        """
+        key = cache_key(filepath)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry
+
+        entry = self._load(filepath)
+        with self._lock:
+            self._stats['misses'] += 1
+            self._etags[entry['etag']] = filepath
+            self._store_locked(key, entry)
+        return entry
+
+    def get_by_etag(self, etag):
+        """
+        Returns the cache entry of the image with the given content hash, or None if no
+        image with that hash has been served (or its file has changed since).
+        """
+        with self._lock:
+            filepath = self._etags.get(etag)
+        if filepath is None:
+            return None
+        try:
+            entry = self.get(filepath)
+        except OSError:
+            return None
+        return entry if entry['etag'] == etag else None
+
+    def _store_locked(self, key, entry):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= old['size']
+        if entry['size'] > self.max_bytes:
+            return  # Larger than the whole cache, serve it without keeping it
+
+        self._entries[key] = entry
+        self._size += entry['size']
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= evicted['size']
+            self._stats['evictions'] += 1
+
+    def invalidate(self, filepath):
+        """
+        Drops a file from the cache and forgets the listing of its folder, so a new
+        or replaced upload is picked up on the next request.
+        """
+        key = cache_key(filepath)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry['size']
+                self._etags.pop(entry['etag'], None)
+            self._listings.pop(os.path.dirname(key), None)
+
+    def list_images(self, folder_path):
+        """
+        Returns the image files of a folder, listing the folder only the first time.
+        """
+        key = cache_key(folder_path)
+        with self._lock:
+            listing = self._listings.get(key)
+        if listing is None:
+            try:
+                listing = sorted(os.path.join(folder_path, file) for file in os.listdir(folder_path)
+                                 if file.lower().endswith(IMAGE_EXTENSIONS))
+            except OSError as e:
+                print(f"Error: {e}")
+                listing = []
+            with self._lock:
+                self._listings[key] = listing
+        return listing
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._size, max_bytes=self.max_bytes)
@@ -0,0 +1,138 @@
+import contextlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from metricsHiPeep import metrics
+
+DB_FILE = 'mooh.db'
+POOL_SIZE = 16  # Idle connections kept open per database file
+BUSY_TIMEOUT_MS = 5000  # How long a writer waits for the write lock before failing
+CACHED_STATEMENTS = 256  # Prepared statements kept per connection by the sqlite3 module
+
+_pools = {}  # db_file -> queue.LifoQueue of idle connections
+_pools_lock = threading.Lock()
+_local = threading.local()  # connections and transaction depth bound to the current thread
+
+
+def _connect(db_file):
+    """
+    Opens a connection in autocommit mode with WAL journaling, so readers never wait
+    for the tracker writes and every statement outside transaction() commits by itself.
+    """
+    conn = sqlite3.connect(db_file, isolation_level=None, check_same_thread=False,
+                           cached_statements=CACHED_STATEMENTS, timeout=BUSY_TIMEOUT_MS / 1000)
+    if conn.execute('PRAGMA journal_mode').fetchone()[0].lower() != 'wal':
+        conn.execute('PRAGMA journal_mode=WAL')  # Persistent, only needs switching once per file
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    return conn
+
+
+def _pool(db_file):
+    with _pools_lock:
+        return _pools.setdefault(db_file, queue.LifoQueue(maxsize=POOL_SIZE))
+
+
+def _bound():
+    if not hasattr(_local, 'connections'):
+        _local.connections = {}
+        _local.depth = {}
+    return _local.connections
+
+
+def _forget_connections():
+    """
+    Drops the inherited pool in a forked child (e.g. a report worker process), SQLite
+    connections must not be shared across processes.
+    """
+    global _pools, _pools_lock, _local
+    _pools = {}
+    _pools_lock = threading.Lock()
+    _local = threading.local()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_connections)
+
+
+def get_connection(db_file=DB_FILE):
+    """
+    Returns the connection bound to the current thread, checking one out of the pool
+    (or opening a new one) the first time the thread touches db_file.
+
+    Statement objects are cached per connection, so reusing the same connection for the
+    same SQL text skips re-preparing it.
+    """
+    connections = _bound()
+    conn = connections.get(db_file)
+    if conn is None:
+        try:
+            conn = _pool(db_file).get_nowait()
+        except queue.Empty:
+            conn = _connect(db_file)
+        connections[db_file] = conn
+    return conn
+
+
+def release_connection(db_file=None):
+    """
+    Returns the current thread's connection(s) to the pool. Call at the end of a request
+    or when a worker thread is done; connections with an open transaction are rolled back.
+    """
+    connections = _bound()
+    for name in ([db_file] if db_file else list(connections)):
+        conn = connections.pop(name, None)
+        if conn is None:
+            continue
+        _local.depth.pop(name, None)
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            _pool(name).put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+@contextlib.contextmanager
+def transaction(db_file=DB_FILE, immediate=False):
+    """
+    Runs the enclosed statements on the thread's connection as one transaction.
+
+    Nested uses join the outermost transaction, so helpers that write can be called
+    inside a request-wide transaction and only the outermost block commits.
+
+    Args:
+        db_file: The path to the SQLite database file.
+        immediate: Take the write lock up front (BEGIN IMMEDIATE) instead of on the first write.
+    """
+    conn = get_connection(db_file)
+    depth = _local.depth.get(db_file, 0)
+    if depth == 0:
+        conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+    _local.depth[db_file] = depth + 1
+    try:
+        yield conn
+    except BaseException:
+        _local.depth[db_file] = depth
+        if depth == 0 and conn.in_transaction:
+            conn.rollback()
+            metrics.count('db.rollbacks')
+        raise
+    else:
+        _local.depth[db_file] = depth
+        if depth == 0:
+            started = time.perf_counter()
+            conn.commit()
+            metrics.observe('db.commit', time.perf_counter() - started)
+
+
+def rows_as_dicts(cursor):
+    """
+    Yields each row of an executed cursor as a {column name: value} dictionary.
+    """
+    column_names = [description[0] for description in cursor.description]
+    for row in cursor:
+        yield dict(zip(column_names, row))
@@ -0,0 +1,195 @@
+import itertools
+
+import numpy as np
+
+from adIndexHiPeep import parse_center
+from dbHiPeep import DB_FILE, get_connection, transaction
+from functionsHiPeep import ROUTE_CHUNK, iter_route_logs_by_adId
+from geoHiPeep import haversine_pairs, segment_distances
+from rollupHiPeep import SECONDS_PER_POINT
+
+SECONDS_PER_DAY = 24 * 3600
+EXPOSURE_FIELDS = ('inZoneSeconds', 'inZoneDistance', 'entries', 'exits', 'inZonePoints')
+
+EXPOSURE_TABLE = '''CREATE TABLE IF NOT EXISTS routeExposure (
+        routeId INTEGER,
+        zone TEXT,
+        inZoneSeconds INTEGER,
+        inZoneDistance REAL,
+        entries INTEGER,
+        exits INTEGER,
+        inZonePoints INTEGER,
+        PRIMARY KEY (routeId, zone)
+    )'''
+INSERT_EXPOSURE = '''INSERT OR REPLACE INTO routeExposure (routeId, zone, inZoneSeconds, inZoneDistance, entries, exits,
+                     inZonePoints) VALUES (?, ?, ?, ?, ?, ?, ?)'''
+
+_tables_checked = set()
+
+
+def ensure_exposure_table(db_file=DB_FILE):
+    if db_file in _tables_checked:
+        return
+    get_connection(db_file).execute(EXPOSURE_TABLE)
+    _tables_checked.add(db_file)
+
+
+def zone_key(center, radius):
+    """
+    Cache key of an ad's zone, exposures are measured again when the ad's zone changes.
+    """
+    return f'{center[0]:.6f},{center[1]:.6f},{float(radius)}'
+
+
+def _route_seconds(times, count):
+    # Seconds of the day of every point, routes whose times aren't HH:MM:SS get SECONDS_PER_POINT per point
+    if isinstance(times, list) or len(times) != count:
+        return np.arange(count, dtype=np.int64) * SECONDS_PER_POINT
+    return np.asarray(times, dtype=np.int64)
+
+
+def measure_exposure(routes):
+    """
+    Measures how much of many routes ran inside their ad's zone, in one vectorized pass.
+
+    A point is inside when its great-circle distance to the center is at most radius km
+    (the route plots only sketch the zone, as a circle of radius * 0.01 degrees). A
+    segment with both ends inside counts fully, one crossing the edge counts for the
+    share of it inside, interpolated on the distances to the center.
+    Segment times come from the timestamps, wrapping at midnight. A route with a single
+    point inside counts SECONDS_PER_POINT.
+
+    Args:
+        routes: (coords, times, center, radius) tuples, coords being an (N, 2) array
+            of (lat, lon), times as route_arrays returns them and radius in km.
+
+    Returns:
+        One dictionary of EXPOSURE_FIELDS per route: seconds and km (rounded to 10 m)
+        in the zone, entries into and exits out of it, and points inside it.
+    """
+    if not routes:
+        return []
+    arrays = [np.asarray(coords, dtype=np.float64).reshape(-1, 2) for coords, _, _, _ in routes]
+    counts = np.array([len(coords) for coords in arrays])
+    points = np.concatenate(arrays)
+    route_of_point = np.repeat(np.arange(len(routes)), counts)
+    centers = np.array([center for _, _, center, _ in routes], dtype=np.float64)[route_of_point]
+    radii = np.array([radius for _, _, _, radius in routes], dtype=np.float64)[route_of_point]
+    seconds = np.concatenate([_route_seconds(times, len(coords)) for (_, times, _, _), coords in zip(routes, arrays)])
+
+    distances = haversine_pairs(points, centers)
+    inside = distances <= radii
+    # Segments joining the last point of a route to the first of the next one don't count
+    same_route = route_of_point[:-1] == route_of_point[1:]
+    start, end = inside[:-1], inside[1:]
+    near = np.minimum(distances[:-1], distances[1:])
+    far = np.maximum(distances[:-1], distances[1:])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing = np.clip((radii[:-1] - near) / (far - near), 0, 1)
+    share = np.where(start & end, 1.0, np.where(start | end, np.nan_to_num(crossing), 0.0)) * same_route
+
+    segment_route = route_of_point[:-1]
+    length = len(routes)
+    # Segments rounded to 10 m like route_length, so a route inside the zone has its whole distance in it
+    in_km = np.bincount(segment_route, np.round(segment_distances(points), 2) * share, minlength=length)
+    in_seconds = np.bincount(segment_route, (np.diff(seconds) % SECONDS_PER_DAY) * share, minlength=length)
+    entries = np.bincount(segment_route, ~start & end & same_route, minlength=length)
+    exits = np.bincount(segment_route, start & ~end & same_route, minlength=length)
+    in_points = np.bincount(route_of_point, inside, minlength=length)
+
+    exposures = []
+    for i, count in enumerate(counts.tolist()):
+        seconds_inside = SECONDS_PER_POINT * int(in_points[i]) if count == 1 else int(round(in_seconds[i]))
+        exposures.append({'inZoneSeconds': seconds_inside, 'inZoneDistance': round(float(in_km[i]), 2),
+                          'entries': int(entries[i]), 'exits': int(exits[i]), 'inZonePoints': int(in_points[i])})
+    return exposures
+
+
+def ad_zones(ad_ids, db_file=DB_FILE):
+    """
+    The zones of the given ads as {adId: (center, radius)}, ads without a valid zone left out.
+    """
+    ad_ids = list(ad_ids)
+    if not ad_ids:
+        return {}
+    zones = {}
+    for adId, center, radius in get_connection(db_file).execute(
+            f'SELECT adId, center, radius FROM adOrders WHERE adId IN ({", ".join("?" * len(ad_ids))})', ad_ids):
+        try:
+            zones[adId] = (parse_center(center), float(radius))
+        except (ValueError, TypeError, AttributeError):
+            continue
+    return zones
+
+
+def route_exposure(logs, zones=None, db_file=DB_FILE):
+    """
+    Exposure of streamed route logs inside the zone of the ad each route ran.
+
+    Cached results are read from routeExposure, the remaining routes are measured in one
+    batch and cached, so a route is measured once per zone of its ad.
+
+    Args:
+        logs: {route_id: details} as iter_route_logs yields them, with every point.
+        zones: Optional {adId: (center, radius)}, looked up in adOrders when missing.
+        db_file: The path to the SQLite database file.
+
+    Returns:
+        {route_id: dictionary of EXPOSURE_FIELDS}, routes of ads without a zone left out.
+    """
+    ensure_exposure_table(db_file)
+    zones = dict(zones or {})
+    zones.update(ad_zones({details['adId'] for details in logs.values()} - set(zones), db_file))
+    keys = {route_id: zone_key(*zones[details['adId']]) for route_id, details in logs.items()
+            if details['adId'] in zones}
+
+    conn = get_connection(db_file)
+    exposures = {}
+    route_ids = list(keys)
+    for offset in range(0, len(route_ids), ROUTE_CHUNK):
+        chunk = route_ids[offset:offset + ROUTE_CHUNK]
+        cursor = conn.execute(f'''SELECT routeId, zone, {", ".join(EXPOSURE_FIELDS)} FROM routeExposure
+                                  WHERE routeId IN ({", ".join("?" * len(chunk))})''', [int(r) for r in chunk])
+        for route_id, zone, *values in cursor:
+            if keys.get(str(route_id)) == zone:
+                exposures[str(route_id)] = dict(zip(EXPOSURE_FIELDS, values))
+
+    missing = [route_id for route_id in route_ids if route_id not in exposures]
+    if missing:
+        measured = measure_exposure([(logs[route_id]['locs'], logs[route_id]['times'],
+                                      *zones[logs[route_id]['adId']]) for route_id in missing])
+        with transaction(db_file):
+            conn.executemany(INSERT_EXPOSURE, [(int(route_id), keys[route_id],
+                                                *(exposure[field] for field in EXPOSURE_FIELDS))
+                                               for route_id, exposure in zip(missing, measured)])
+        exposures.update(zip(missing, measured))
+    return exposures
+
+
+def exposure_totals(exposures):
+    """
+    Sums route exposures into campaign totals, km rounded to 10 m.
+    """
+    totals = dict.fromkeys(EXPOSURE_FIELDS, 0)
+    for exposure in exposures:
+        for field in EXPOSURE_FIELDS:
+            totals[field] += exposure[field]
+    totals['inZoneDistance'] = round(totals['inZoneDistance'], 2)
+    return totals
+
+
+def campaign_exposure(adId, since=None, until=None, db_file=DB_FILE):
+    """
+    Exposure totals of an ad's campaign, optionally for the routes overlapping a time
+    window, streaming its routes ROUTE_CHUNK at a time.
+    """
+    zones = ad_zones([adId], db_file)
+    routes = iter_route_logs_by_adId(adId, since, until)
+    totals = exposure_totals([])
+    while True:
+        logs = dict(itertools.islice(routes, ROUTE_CHUNK))
+        if not logs:
+            return totals
+        chunk = exposure_totals(list(route_exposure(logs, zones, db_file).values()))
+        totals = {field: totals[field] + chunk[field] for field in EXPOSURE_FIELDS}
+        totals['inZoneDistance'] = round(totals['inZoneDistance'], 2)
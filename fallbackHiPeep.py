@@ -0,0 +1,141 @@
+import collections
+import itertools
+import threading
+import time
+import zlib
+
+from imageVariantsHiPeep import is_valid_image
+
+MEMES_PER_ZONE = 4  # Memes a zone rotates through, the ones its cars are told to prefetch
+PREFETCH_HORIZON = 30 * 60  # Seconds ahead an ad's schedule is looked at for the prefetch manifest
+PREFETCH_STEP = 5 * 60  # Seconds between the schedule checks within the horizon
+PREFETCH_ADS = 3  # Most ads listed in a prefetch manifest
+PREFETCH_TTL = 60.0  # Seconds a zone's manifest is reused before it is built again
+MAX_ZONES = 10000  # Zones whose manifest is kept, the least recently polled are dropped
+
+
+def creative_reference(creative):
+    return {"imageHash": creative['etag'], "imageUrl": f"/creative/{creative['etag']}"}
+
+
+class FallbackPool:
+    """
+    The memes sent when no ad matches, loaded into memory once at startup.
+
+    Each meme's response fields are prepared up front, for both the embedded and the by
+    reference image mode, so a fallback poll is a counter step and a dictionary copy.
+    The pool keeps its own reference to every creative, a meme evicted from the creative
+    cache stays in memory here. Every zone rotates through its own MEMES_PER_ZONE memes,
+    the same ones the prefetch manifest lists for it.
+    """
+
+    def __init__(self, runtime, radius, memes_per_zone=MEMES_PER_ZONE):
+        self.runtime = runtime
+        self.radius = radius
+        self.memes_per_zone = memes_per_zone
+        self._memes = []  # (creative, embedded response, by reference response)
+        self._turns = itertools.count()
+
+    def __len__(self):
+        return len(self._memes)
+
+    def load(self, creatives):
+        """
+        Fills the pool from creative cache entries, replacing what it held. Entries that
+        don't decode as an image are left out, they would reach every car of their zones.
+
+        Returns:
+            The number of memes in the pool.
+        """
+        memes = []
+        for creative in creatives:
+            if not is_valid_image(creative['data']):
+                print(f"Skipping meme {creative['path']}, it is not a valid image")
+                continue
+            response = {"message": "Meme Sent", "status": "success", "runTime": self.runtime,
+                        "radius": self.radius, "adId": 0}
+            memes.append((creative, dict(response, image=creative['base64']),
+                          dict(response, **creative_reference(creative))))
+        self._memes = memes
+        return len(memes)
+
+    def zone_memes(self, zone):
+        """
+        The pool entries a zone rotates through, a stable slice of the pool per zone.
+        """
+        memes = self._memes
+        if len(memes) <= self.memes_per_zone:
+            return memes
+        first = zlib.crc32(repr(zone).encode()) % len(memes)
+        return [memes[(first + i) % len(memes)] for i in range(self.memes_per_zone)]
+
+    def response(self, zone, location, image_by_ref):
+        """
+        The /endpoint response of a fallback poll at location, or None if the pool is empty.
+        """
+        memes = self.zone_memes(zone)
+        if not memes:
+            return None
+        _, embedded, by_ref = memes[next(self._turns) % len(memes)]
+        return dict(by_ref if image_by_ref else embedded, center=location)
+
+    def stats(self):
+        return {'memes': len(self._memes), 'bytes': sum(creative['size'] for creative, _, _ in self._memes)}
+
+
+class PrefetchPlanner:
+    """
+    Builds the prefetch manifest sent with /endpoint responses: the creatives a car is
+    likely to be sent next in its zone, so it can download them ahead of time.
+
+    A manifest lists the ads live in the zone now or within PREFETCH_HORIZON, and the
+    zone's fallback memes, each by content hash and /creative URL and listed once per
+    hash. Manifests are cached per zone for ttl seconds, so most polls reuse one, and
+    are shared between responses, so they must not be modified.
+
+    Args:
+        ads_for: ads_for(location) returning (adId, creative) pairs of the upcoming ads.
+        pool: The FallbackPool whose zone memes are listed.
+    """
+
+    def __init__(self, ads_for, pool, ttl=PREFETCH_TTL, max_zones=MAX_ZONES):
+        self.ads_for = ads_for
+        self.pool = pool
+        self.ttl = ttl
+        self.max_zones = max_zones
+        self._manifests = collections.OrderedDict()  # zone -> (expires, manifest), least recently polled first
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'builds': 0}
+
+    def manifest(self, zone, location):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._manifests.get(zone)
+            if cached is not None and cached[0] > now:
+                self._manifests.move_to_end(zone)
+                self._stats['hits'] += 1
+                return cached[1]
+
+        # Built outside the lock, two polls of a new zone may both build it
+        manifest, listed = [], set()
+        entries = [('ad', {'adId': adId}, creative) for adId, creative in self.ads_for(location)]
+        entries += [('meme', {}, creative) for creative, _, _ in self.pool.zone_memes(zone)]
+        for kind, fields, creative in entries:
+            if creative['etag'] not in listed:  # Ads sharing a creative are downloaded once
+                listed.add(creative['etag'])
+                manifest.append(dict(kind=kind, **fields, **creative_reference(creative)))
+        with self._lock:
+            self._manifests[zone] = (now + self.ttl, manifest)
+            self._manifests.move_to_end(zone)
+            if len(self._manifests) > self.max_zones:
+                self._manifests.popitem(last=False)
+            self._stats['builds'] += 1
+        return manifest
+
+    def clear(self):
+        with self._lock:
+            self._manifests.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, zones=len(self._manifests))
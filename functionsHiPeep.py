@@ -1,27 +1,42 @@
-import base64
-import datetime
+import itertools
 import json
-import os
-import pprint
-import random
-
-import matplotlib.pyplot as plt
-from matplotlib.patches import Circle
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, Table, TableStyle
-from reportlab.lib.styles import getSampleStyleSheet
 import sqlite3
 import math
 
+from adIndexHiPeep import AdSpatialIndex
+from dbHiPeep import DB_FILE, get_connection, rows_as_dicts, transaction
+from geoHiPeep import haversine_many, route_length, route_lengths
+from metricsHiPeep import COUNT_BUCKETS, metrics
+from partitionHiPeep import iter_archived_rows, window_clause
+from rankingHiPeep import ZoneRotation
+from rollupHiPeep import ensure_rollup_tables
+from routeCodecHiPeep import ensure_trackerLog_schema, route_arrays
+from scheduleHiPeep import CompiledSchedule, ScheduleEngine, to_epoch_seconds
 
-def fetch_row_as_dict(db_file, table_name, pk_column, pk_value):
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
+_active_ads = None  # AdSpatialIndex of adOrders rows with runTime left, built on first use
+_schedules = ScheduleEngine()  # Compiled time frames of the ads in _active_ads
+_rotation = ZoneRotation()  # Per-zone fair rotation of the ads eligible there
+
+# Report rendering lives in reportsHiPeep, which pulls in matplotlib and ReportLab. Its names
+# are still importable from here, the module is only loaded when one of them is first used.
+REPORT_NAMES = ('PLOT_DPI', 'REPORT_TOLERANCE_M', 'REPORT_MAX_POINTS', 'simplify_for_report', 'points_label',
+                'period_label', 'format_coordinates', 'format_timestamps', 'save_plot_as_image', 'ad_report_data',
+                'route_plot_tasks', 'render_route_plot', 'copy_cached_report', 'build_ad_report_pdf',
+                'write_ad_report_pdf', 'generate_report_for_adId', 'generate_report_for_carId',
+                'write_car_report_pdf')
+
+
+def __getattr__(name):
+    if name in REPORT_NAMES:
+        import reportsHiPeep
+        return getattr(reportsHiPeep, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
+
+def fetch_row_as_dict(db_file, table_name, pk_column, pk_value):
     query = f"SELECT * FROM {table_name} WHERE {pk_column} = ?"
-    cursor.execute(query, (pk_value,))
+    cursor = get_connection(db_file).execute(query, (pk_value,))
     row = cursor.fetchone()
-    # row = cursor.fetchall()
 
     if row is None:
         return None  # Handle the case where the row doesn't exist
@@ -30,34 +45,15 @@ def fetch_row_as_dict(db_file, table_name, pk_column, pk_value):
     column_names = [description[0] for description in cursor.description]
 
     # Create a dictionary from the row tuple
-    row_dict = dict(zip(column_names, row))
-    conn.close()
-    return row_dict
+    return dict(zip(column_names, row))
 
 
 def fetch_all_as_dict(db_file, table_name, pk_column, pk_value):
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-
     query = f"SELECT * FROM {table_name} WHERE {pk_column} = ?"
-    cursor.execute(query, (pk_value,))
-    all = cursor.fetchall()
-    # row = cursor.fetchall()
+    cursor = get_connection(db_file).execute(query, (pk_value,))
 
-    if all is None:
-        return None  # Handle the case where the row doesn't exist
-
-    # Get column names directly from the cursor description
-    column_names = [description[0] for description in cursor.description]
-
-    # Create a dictionary from the row tuple
-    result = {}
-    for i, row in enumerate(all, 1):
-        row_dict = dict(zip(column_names, row))
-        result[i] = row_dict
-
-    conn.close()
-    return result
+    # Create a dictionary from the row tuples
+    return {i: row_dict for i, row_dict in enumerate(rows_as_dicts(cursor), 1)}
 
 
 def fetch_all_as_dict_with_condition(db_file, table_name, pk_column, condition, value):
@@ -76,51 +72,28 @@ def fetch_all_as_dict_with_condition(db_file, table_name, pk_column, condition,
     """
 
     try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-
         query = f"SELECT * FROM {table_name} WHERE {pk_column} {condition} ?"
-        cursor.execute(query, (value,))
-        rows = cursor.fetchall()
-
-        if not rows:
-            return None
-
-        # Get column names directly from the cursor description
-        column_names = [description[0] for description in cursor.description]
+        cursor = get_connection(db_file).execute(query, (value,))
 
         # Create a dictionary of dictionaries, where each inner dictionary represents a row
-        result = {i: dict(zip(column_names, row)) for i, row in enumerate(rows, 1)}
+        result = {i: row_dict for i, row_dict in enumerate(rows_as_dicts(cursor), 1)}
 
-        return result
+        return result or None
 
     except sqlite3.Error as e:
         print(f"Error fetching data: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
 
 
 def update_sql(db_file, table_name, pk_column, pk_value, column_to_update, new_value):
-    conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-
     query = f"UPDATE {table_name} SET {column_to_update} = ? WHERE {pk_column} = ?"
-    cursor.execute(query, (new_value, pk_value))
-
-    conn.commit()  # Commit the changes
-    conn.close()
+    # Commits straight away, or with the enclosing transaction() if there is one
+    get_connection(db_file).execute(query, (new_value, pk_value))
     print(f'updated the database {db_file} table {table_name} '
           f'of primary key {pk_column} of value {pk_value} in column {column_to_update} with value {new_value}\n')
 
-
-def encode_image_to_base64(filepath):
-    """
-    Helper function to encode an image file to a base64 string.
-    """
-    with open(filepath, "rb") as img_file:
-        return base64.b64encode(img_file.read()).decode('utf-8')
+    if table_name == 'adOrders' and pk_column.lower() == 'adid':
+        refresh_ad_in_index(pk_value)
 
 
 def is_within_valid_time_frames(time_frames):
@@ -140,43 +113,188 @@ def is_within_valid_time_frames(time_frames):
         True if the current date and time is within a valid time frame, False otherwise.
     """
 
-    current_datetime = datetime.datetime.now()
-    current_date = current_datetime.date()
-    current_time = current_datetime.time()
+    return CompiledSchedule.from_time_frames(time_frames).contains()
 
-    for i in range(len(time_frames['fromDates'])):
-        from_date = datetime.datetime.strptime(time_frames['fromDates'][i], '%Y-%m-%d').date()
-        from_time = datetime.datetime.strptime(time_frames['fromTimes'][i], '%H:%M').time()
-        to_date = datetime.datetime.strptime(time_frames['toDates'][i], '%Y-%m-%d').date()
-        to_time = datetime.datetime.strptime(time_frames['toTimes'][i], '%H:%M').time()
 
-        # print(f'fromDate:{from_date}, currentDate:{current_date}, toDate:{to_date}')
-        # print(f'fromTime:{from_time}, currentTime:{current_time}, toTime:{to_time}')
+def has_runtime_left(row):
+    try:
+        return float(row['runTime']) > 0
+    except (TypeError, ValueError):
+        return False
 
-        if (current_date >= from_date and current_time >= from_time) and \
-                (current_date <= to_date and current_time <= to_time):
-            return True
 
-    return False
+def load_active_ads():
+    """
+    (Re)builds the in-memory spatial index of ads that still have runtime left.
+    """
+    global _active_ads
+    index = AdSpatialIndex()
+    _schedules.clear()
+    adsInQueue = fetch_all_as_dict_with_condition(DB_FILE, 'adOrders', 'runTime', '>', 0)
+    for row in (adsInQueue or {}).values():
+        if has_runtime_left(row):
+            entry = index.add(row)
+            if entry is not None:
+                _schedules.set_schedule(row['adId'], entry['timeFrames'])
+    _active_ads = index
+    return index
+
+
+def active_ads_index():
+    if _active_ads is None:
+        return load_active_ads()
+    return _active_ads
+
+
+def refresh_ad_in_index(adId):
+    """
+    Re-reads a single adOrders row and updates its entry in the spatial index.
+    Called whenever adOrders is written so the index never serves stale campaigns.
+    """
+    if _active_ads is None:
+        return  # Index not built yet, it will be loaded fresh on first use
+
+    row = fetch_row_as_dict(DB_FILE, 'adOrders', 'adId', adId)
+    entry = None
+    if row is not None and has_runtime_left(row):
+        entry = _active_ads.add(row)
 
+    if entry is None:
+        _active_ads.remove(adId)
+        _schedules.remove(adId)
+    else:
+        _schedules.set_schedule(adId, entry['timeFrames'])
 
-def validAdToRun(location):
-    adsInQueue = fetch_all_as_dict_with_condition('mooh.db', 'adOrders', 'runTime', '>', 0)
-    if adsInQueue:
-        for items in adsInQueue:
-            timeFrames = {'fromDates': json.loads(adsInQueue[items]['fromDates']),
-                          'fromTimes': json.loads(adsInQueue[items]['fromTimes']),
-                          'toDates': json.loads(adsInQueue[items]['toDates']),
-                          'toTimes': json.loads(adsInQueue[items]['toTimes'])}
 
-            center = tuple(map(float, list(adsInQueue[items]['center'].split(','))))
-            with_in_timeFrame = is_within_valid_time_frames(timeFrames)
-            with_in_radius = haversine_distance(center, location) <= int(adsInQueue[items]['radius'])
-            print(adsInQueue[items]['adId'], with_in_timeFrame, with_in_radius)
-            if with_in_timeFrame and with_in_radius:
-                return adsInQueue[items]
+def index_adOrders_rows(rows):
+    """
+    Updates the spatial index from adOrders rows that were just written, without
+    re-reading them from the database.
+    """
+    if _active_ads is None:
+        return  # Index not built yet, it will be loaded fresh on first use
+
+    for row in rows:
+        entry = _active_ads.add(row) if has_runtime_left(row) else None
+        if entry is None:
+            _active_ads.remove(row['adId'])
+            _schedules.remove(row['adId'])
         else:
-            return None
+            _schedules.set_schedule(row['adId'], entry['timeFrames'])
+
+
+def set_ad_runtime_in_index(adId, runTime):
+    """
+    Applies a runTime change to the in-memory index ahead of its (batched) database write,
+    so ad selection sees it straight away.
+    """
+    if _active_ads is None:
+        return
+
+    entry = _active_ads.get(adId)
+    if entry is None:
+        row = fetch_row_as_dict(DB_FILE, 'adOrders', 'adId', adId)
+        if row is None:
+            return
+    else:
+        row = entry['row']
+        if has_runtime_left({'runTime': runTime}):
+            # Still indexed and still runnable, only the runTime changes
+            row['runTime'] = runTime
+            return
+
+    row = dict(row, runTime=runTime)
+    if has_runtime_left(row):
+        entry = _active_ads.add(row)
+        if entry is not None:
+            _schedules.set_schedule(adId, entry['timeFrames'])
+    else:
+        _active_ads.remove(adId)
+        _schedules.remove(adId)
+
+
+def _remaining_runtime(row):
+    try:
+        return max(float(row['runTime']), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def rotation():
+    return _rotation
+
+
+def validAdToRun(location, reserve=None, remaining=None):
+    """
+    Picks the ad a car at location shows next.
+
+    All indexed ads that are live and whose radius covers the location are gathered in
+    one pass, then tried in the order of the zone's fair rotation, which favours ads
+    with more budget left, closer centers and fewer recent impressions in the zone.
+
+    Args:
+        location: The (latitude, longitude) of the car.
+        reserve: Optional reserve(row) callback returning the runTime granted to the car,
+            candidates it grants nothing are skipped.
+        remaining: Optional remaining(row) callback returning an ad's budget left for
+            ranking, defaults to the row's runTime.
+
+    Returns:
+        A copy of the ad's adOrders row, its runTime being the granted one, or None.
+    """
+    candidates = active_ads_index().candidates(location)
+    metrics.observe('poll.ads_scanned', len(candidates), COUNT_BUCKETS)
+    if not candidates:
+        return None
+
+    remaining = remaining or _remaining_runtime
+    now = to_epoch_seconds()
+    # Distances from the car to every candidate center in one call
+    distances = haversine_many(tuple(map(float, location)),
+                               [entry['center'][0] for entry in candidates],
+                               [entry['center'][1] for entry in candidates]).tolist()
+    eligible = {}  # adId -> (entry, remaining budget, distance / radius)
+    for entry, distance in zip(candidates, distances):
+        with_in_timeFrame = _schedules.is_live(entry['row']['adId'], now)
+        with_in_radius = distance <= entry['radius']
+        print(entry['row']['adId'], with_in_timeFrame, with_in_radius)
+        if with_in_timeFrame and with_in_radius:
+            budget = remaining(entry['row'])
+            if budget > 0:
+                eligible[entry['row']['adId']] = (entry, budget, distance / entry['radius'] if entry['radius'] else 0)
+    metrics.observe('poll.ads_eligible', len(eligible), COUNT_BUCKETS)
+
+    ranking = {adId: (budget, distance) for adId, (_, budget, distance) in eligible.items()}
+    for adId in _rotation.order(location, ranking):
+        row = eligible[adId][0]['row']
+        granted = row['runTime'] if reserve is None else reserve(row)
+        if reserve is None or granted > 0:
+            _rotation.shown(location, adId)
+            return dict(row, runTime=granted)
+    return None
+
+
+def upcoming_ads(location, horizon, step):
+    """
+    The ads whose radius covers location and that are live now or within the next
+    horizon seconds (checked every step seconds), closest centers relative to their
+    radius first. Budgets are not checked, these are hints of what a car may be sent.
+
+    Returns:
+        The adOrders rows of the ads, as held by the index (not to be modified).
+    """
+    candidates = active_ads_index().candidates(location)
+    if not candidates:
+        return []
+    now = to_epoch_seconds()
+    moments = [now + offset for offset in range(0, horizon + 1, step)]
+    distances = haversine_many(tuple(map(float, location)),
+                               [entry['center'][0] for entry in candidates],
+                               [entry['center'][1] for entry in candidates]).tolist()
+    covering = [(distance / entry['radius'] if entry['radius'] else 0, entry['row']['adId'], entry['row'])
+                for entry, distance in zip(candidates, distances)
+                if distance <= entry['radius'] and any(_schedules.is_live_many(entry['row']['adId'], moments))]
+    return [row for _, _, row in sorted(covering, key=lambda item: item[:2])]
 
 
 def haversine_distance(coord1, coord2):
@@ -209,211 +327,146 @@ def calculate_distances(coords):
     Calculate distances between consecutive latitude-longitude pairs.
 
     Args:
-      coords (list of tuples): List of (latitude, longitude) tuples.
+      coords (list of tuples): List of (latitude, longitude) tuples, or an (N, 2) array.
 
     Returns:
-      list of floats: Distances in kilometers between consecutive points.
+      float: Sum of the distances in kilometers between consecutive points, each rounded to 10 m.
     """
-    distances = []
-    if len(coords) == 1:
-        return 0.2
-    else:
-        for i in range(len(coords) - 1):
-            distance = haversine_distance(coords[i], coords[i + 1])
-            distances.append(round(distance, 2))
-    return round(sum(distances), 2)
-
-
-def route_log_by_adId(adId):
-    route_logs = fetch_all_as_dict('mooh.db', 'trackerLog', 'adId', adId)
-    adLog = fetch_row_as_dict('mooh.db', 'adOrders', 'adId', adId)
-    poster = adLog['fileUploaded']
-
-    log = {}
-
-    # Process each log entry
-    for items in route_logs:
-        # Parse location data into a list of (x, y) tuples
-        coordinates = []
-
-        for pair in route_logs[items]['locs'].rstrip('*').split('*'):
-            if pair:  # Ensure the pair is not empty
-                x, y = map(float, pair.split(':'))
-                coordinates.append((x, y))
+    return route_length(coords)
 
-        # Store data in the dictionary
-        if len(coordinates) != 0:
-            log[str(route_logs[items]['routeId'])] = {
-                "locs": coordinates,
-                "times": route_logs[items]['times'].rstrip('*').split('*'),
-                "distance": calculate_distances(coordinates),
-                "runtime": len(route_logs[items]['times'].rstrip('*').split('*')) * 30,
-                "carId": route_logs[items]['carId']
-            }
 
-    total_distance = 0
-    total_time = 0
-    for items in log:
-        total_distance += log[items]['distance']
-        total_time += log[items]['runtime']
+ROUTE_CHUNK = 256  # Routes decoded and measured per vectorized batch while streaming
 
-    return log, round(total_distance, 2), total_time, poster
+# Routes come with their rollup, measured on the points as reported even if they were stored simplified
+ROUTES_BY_AD_QUERY = """SELECT trackerLog.*, routeRollup.distance AS rolledDistance, routeRollup.runtime AS rolledRuntime
+                        FROM trackerLog LEFT JOIN routeRollup ON routeRollup.routeId = trackerLog.routeId
+                        WHERE trackerLog.adId = ?{window} ORDER BY trackerLog.routeId"""
+ROUTES_BY_CAR_QUERY = """SELECT trackerLog.*, routeRollup.distance AS rolledDistance, routeRollup.runtime AS rolledRuntime,
+                                adOrders.fileUploaded AS poster
+                         FROM trackerLog LEFT JOIN routeRollup ON routeRollup.routeId = trackerLog.routeId
+                                         LEFT JOIN adOrders ON adOrders.adId = trackerLog.adId
+                         WHERE trackerLog.carId = ?{window} ORDER BY trackerLog.routeId"""
+ROUTE_QUERIES = {'adId': ROUTES_BY_AD_QUERY, 'carId': ROUTES_BY_CAR_QUERY}
 
 
-def route_log_by_carId(carId):
-    conn = sqlite3.connect('mooh.db')
-    cursor = conn.cursor()
-
-    # Query the database for records with the given adId
-    query = "SELECT * FROM trackerLog WHERE carId = ?"
-    cursor.execute(query, (carId,))
-    routes_logs = cursor.fetchall()
+def route_rows(column, value, since=None, until=None):
+    """
+    Streams the trackerLog rows of an ad or car (column 'adId' or 'carId') with their
+    rollup, and for cars the poster of the ad, archived partitions first.
 
-    log = {}
+    With since and/or until (see partitionHiPeep.window_bounds) only the routes whose
+    time span overlaps the window are read, through the startedAt indexes and the
+    archives covering the window.
+    """
+    ensure_trackerLog_schema(DB_FILE)
+    ensure_rollup_tables(DB_FILE)
+    window, params = window_clause(since, until)
+    hot = rows_as_dicts(get_connection(DB_FILE).execute(ROUTE_QUERIES[column].format(window=window), (value, *params)))
+    return itertools.chain(archived_route_rows(column, value, since, until), hot)
 
-    # Process each log entry
-    for items in routes_logs:
-        route_id, carId, adId, locs, times = items
 
-        # Parse location data into a list of (x, y) tuples
-        coordinates = []
-        for pair in locs.rstrip('*').split('*'):
-            if pair:  # Ensure the pair is not empty
-                x, y = map(float, pair.split(':'))
-                coordinates.append((x, y))
+def archived_route_rows(column, value, since=None, until=None):
+    """
+    The archived rows of route_rows, joined with their rollup (and poster) ROUTE_CHUNK at a time.
+    """
+    conn = get_connection(DB_FILE)
+    rows = iter_archived_rows(column, value, since, until, DB_FILE)
+    while True:
+        chunk = list(itertools.islice(rows, ROUTE_CHUNK))
+        if not chunk:
+            return
+        route_ids = [row['routeId'] for row in chunk]
+        rolled = {route_id: (distance, runtime) for route_id, distance, runtime in conn.execute(
+            f'SELECT routeId, distance, runtime FROM routeRollup WHERE routeId IN ({", ".join("?" * len(route_ids))})',
+            route_ids)}
+        if column == 'carId':
+            ad_ids = list({row['adId'] for row in chunk})
+            posters = dict(conn.execute(
+                f'SELECT adId, fileUploaded FROM adOrders WHERE adId IN ({", ".join("?" * len(ad_ids))})', ad_ids))
+        for row in chunk:
+            row['rolledDistance'], row['rolledRuntime'] = rolled.get(row['routeId'], (None, None))
+            if column == 'carId':
+                row['poster'] = posters.get(row['adId'])
+            yield row
+
+
+def iter_route_logs(rows):
+    """
+    Streams routes read by route_rows as (route_id, details) pairs.
 
-        # Store data in the dictionary
-        if len(coordinates) != 0:
-            log[str(route_id)] = {
+    Rows are read from the cursor and measured ROUTE_CHUNK at a time, so memory stays
+    flat however many routes match. Distances and runtimes come from routeRollup, routes
+    without a rollup are measured here. Routes without points are skipped.
+    """
+    while True:
+        chunk = []
+        for items in itertools.islice(rows, ROUTE_CHUNK):
+            # Decode location data into an (N, 2) array of (x, y)
+            coordinates, times = route_arrays(items)
+            if len(coordinates) != 0:
+                chunk.append((str(items['routeId']), items, coordinates, times))
+        if not chunk:
+            return
+
+        # Route lengths of the routes without a rollup in one vectorized pass
+        lengths = iter(route_lengths([coordinates for _, items, coordinates, _ in chunk
+                                      if items['rolledDistance'] is None]))
+        for route_id, items, coordinates, times in chunk:
+            rolled = items['rolledDistance'] is not None
+            details = {
                 "locs": coordinates,
-                "times": times.rstrip('*').split('*'),
-                "distance": calculate_distances(coordinates),
-                "runtime": len(times.rstrip('*').split('*')) * 30,
-                "adId": adId,
-                "poster": fetch_row_as_dict('mooh.db', 'adOrders', 'adId', adId)['fileUploaded']
+                "times": times,
+                "distance": items['rolledDistance'] if rolled else next(lengths),
+                "runtime": items['rolledRuntime'] if rolled else len(times) * 30,
+                "carId": items['carId'],
+                "adId": items['adId']
             }
+            if 'poster' in items:
+                details['poster'] = items['poster']
+            yield route_id, details
 
-    conn.close()  # Close the database connection
-
-    total_distance = 0
-    total_time = 0
-    for items in log:
-        total_distance += log[items]['distance']
-        total_time += log[items]['runtime']
 
-    return log, round(total_distance, 2), total_time
+def iter_route_logs_by_adId(adId, since=None, until=None):
+    return iter_route_logs(route_rows('adId', adId, since, until))
 
 
-def save_plot_as_image(list_of_tuples_of_xys, center, radius, file_name):
+def iter_route_logs_by_carId(carId, since=None, until=None):
     """
-    Saves the route graph as an image file with accurate rendering.
+    Streams a car's routes together with the poster of the ad each one ran, in one joined query.
     """
-    x_values, y_values = zip(*list_of_tuples_of_xys)
-
-    # Create the figure and axis
-    plt.figure()  # Start a new figure
-    plt.plot(x_values, y_values, marker='*')  # Plot points and line
-
-    plt.xlabel('Latitude')
-    plt.ylabel('Longitude')
-    plt.grid(True)
-
-    # Create the circle object
-    circle = Circle(xy=center, radius=radius * 0.01, color='grey', fill=False)
-
-    # Add the circle to the plot
-    ax = plt.gca()  # Get the current axis
-    ax.add_patch(circle)
-
-    # Highlight the center of the circle
-    plt.scatter(center[0], center[1], color='red', s=100)  # Center marker
-
-    # Ensure equal aspect ratio
-    ax.set_aspect("equal")
-
-    # Save the plot as an image
-    plt.savefig(file_name, format='png', dpi=300)  # Save with high resolution
-    plt.close()  # Close the plot to avoid overlap
+    return iter_route_logs(route_rows('carId', carId, since, until))
 
 
-def generate_report_for_adId(adId):
+def route_totals(route_logs):
     """
-    Creates a PDF report with route logs, distances, and graphs.
-    """
-
-    logs, total_distance, total_runtime, poster = route_log_by_adId(adId)
-    adData = fetch_row_as_dict('mooh.db', 'adOrders', 'adID', 8)
-    center = tuple(map(float, adData['center'].split(',')))
-
-    doc = SimpleDocTemplate('adReportFile.pdf', pagesize=letter)
-    styles = getSampleStyleSheet()
-
-    elements = [Paragraph("Route Logs Report", styles['Title']), Spacer(1, 12)]
-
-    # Add summary
-    summary = f"Total Distance: {total_distance} km<br/>Total Runtime: {total_runtime} seconds"
-    elements.append(Paragraph(summary, styles['Normal']))
-    elements.append(Spacer(1, 12))
-    elements.append(Image(poster, width=400, height=300))
-
-    # Add route details
-    for route_id, details in logs.items():
-        elements.append(Paragraph(f"Route ID: {route_id}", styles['Heading2']))
-        elements.append(Paragraph(f"car ID: {details['carId']}", styles['Normal']))
-        elements.append(Paragraph(f"Distance: {details['distance']} km", styles['Normal']))
-        elements.append(Paragraph(f"Runtime: {details['runtime']} seconds", styles['Normal']))
-        elements.append(Paragraph(f"Coordinates: {details['locs']}", styles['Normal']))
-        elements.append(Paragraph(f"Timestamps: {details['times']}", styles['Normal']))
-
-        # Add route graph
-        graph_image = f"routes/route_{route_id}.png"
-        save_plot_as_image(details['locs'], center, int(adData['radius']), graph_image)
-        elements.append(Image(graph_image, width=400, height=300))
-        elements.append(Spacer(1, 12))
-        print(route_id)
+    Sums the distance and runtime of streamed route logs without keeping them.
 
-    # Build the PDF
-    doc.build(elements)
-    print(f"PDF report generated")
-
-
-def generate_report_for_carId(carId):
-    """
-    Creates a PDF report with route logs, distances, and graphs.
+    Returns:
+        (total distance in km rounded to 10 m, total runtime in seconds)
     """
+    total_distance = 0
+    total_time = 0
+    for _, details in route_logs:
+        total_distance += details['distance']
+        total_time += details['runtime']
+    return round(total_distance, 2), total_time
 
-    logs, total_distance, total_runtime = route_log_by_carId(carId)
-
-    doc = SimpleDocTemplate('carReportFile.pdf', pagesize=letter)
-    styles = getSampleStyleSheet()
 
-    elements = []
+def route_log_by_adId(adId, since=None, until=None):
+    adLog = fetch_row_as_dict(DB_FILE, 'adOrders', 'adId', adId)
+    poster = adLog['fileUploaded']
 
-    # Add Title
-    elements.append(Paragraph(f"{carId} Log Report", styles['Title']))
-    elements.append(Spacer(1, 12))
+    log = dict(iter_route_logs_by_adId(adId, since, until))
+    total_distance, total_time = route_totals(log.items())
 
-    # Add summary
-    summary = f"Total Distance: {total_distance} km<br/>Total Runtime: {total_runtime} seconds"
-    elements.append(Paragraph(summary, styles['Normal']))
-    elements.append(Spacer(1, 12))
+    return log, total_distance, total_time, poster
 
-    # Add route details
-    for route_id, details in logs.items():
-        elements.append(Paragraph(f"Route ID: {route_id}", styles['Heading2']))
-        elements.append(Paragraph(f"Distance: {details['distance']} km", styles['Normal']))
-        elements.append(Paragraph(f"Runtime: {details['runtime']} seconds", styles['Normal']))
-        elements.append(Paragraph(f"Coordinates: {details['locs']}", styles['Normal']))
-        elements.append(Paragraph(f"Timestamps: {details['times']}", styles['Normal']))
 
-        # Add route graph
-        poster = details['poster']
-        elements.append(Image(poster, width=400, height=300))
-        elements.append(Spacer(1, 12))
+def route_log_by_carId(carId, since=None, until=None):
+    log = dict(iter_route_logs_by_carId(carId, since, until))
+    total_distance, total_time = route_totals(log.items())
 
-    # Build the PDF
-    doc.build(elements)
-    print(f"PDF report generated")
+    return log, total_distance, total_time
 
 
 def save_adOrders_to_db(data):
@@ -427,76 +480,115 @@ def save_adOrders_to_db(data):
         The newly generated adId, or the existing adId if the record was updated.
     """
 
-    conn = sqlite3.connect('mooh.db')
-    cursor = conn.cursor()
-
-    # Check for existing ad with the same user, center, and fileUploaded
-    cursor.execute('''
-        SELECT adId FROM adOrders
-        WHERE user = ? AND center = ? AND fileUploaded = ?
-    ''', (data['user'], data['center'], data['fileUploaded']))
-    existing_ad = cursor.fetchone()
-
-    if existing_ad:
-        # Update the existing record if necessary
-        if data.get('fromDates') or data.get('fromTimes') or \
-                data.get('toDates') or data.get('toTimes') or \
-                data.get('runTimes') or data.get('radius'):
-            cursor.execute('''
-                UPDATE adOrders
-                SET fromDates = ?, fromTimes = ?, toDates = ?, toTimes = ?, runTime = ?, radius = ?
-                WHERE adId = ?
-            ''', (
-                json.dumps(data.get('fromDates', [])),
-                json.dumps(data.get('fromTimes', [])),
-                json.dumps(data.get('toDates', [])),
-                json.dumps(data.get('toTimes', [])),
-                data.get('runTime'),
-                data.get('radius'),
-                existing_ad[0]
-            ))
-            conn.commit()
-            return existing_ad[0]
-        else:
-            return existing_ad[0]  # No need to update, return the existing adId
-
-    # Insert the new ad
     try:
-        cursor.execute('''
-            INSERT INTO adOrders (user, center, email, fileUploaded, fromDates, fromTimes, radius, runTime, toDates, toTimes)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (data['user'], data['center'], data['email'], data['fileUploaded'],
-              json.dumps(data['fromDates']), json.dumps(data['fromTimes']), data['radius'], data['runTime'],
-              json.dumps(data['toDates']), json.dumps(data['toTimes'])))
-        conn.commit()
-        new_id = cursor.lastrowid
-        return new_id
+        with transaction(DB_FILE, immediate=True) as conn:
+            # Check for existing ad with the same user, center, and fileUploaded
+            existing_ad = conn.execute('''
+                SELECT adId FROM adOrders
+                WHERE user = ? AND center = ? AND fileUploaded = ?
+            ''', (data['user'], data['center'], data['fileUploaded'])).fetchone()
+
+            if existing_ad:
+                # Update the existing record if necessary
+                if data.get('fromDates') or data.get('fromTimes') or \
+                        data.get('toDates') or data.get('toTimes') or \
+                        data.get('runTimes') or data.get('radius'):
+                    conn.execute('''
+                        UPDATE adOrders
+                        SET fromDates = ?, fromTimes = ?, toDates = ?, toTimes = ?, runTime = ?, radius = ?
+                        WHERE adId = ?
+                    ''', (
+                        json.dumps(data.get('fromDates', [])),
+                        json.dumps(data.get('fromTimes', [])),
+                        json.dumps(data.get('toDates', [])),
+                        json.dumps(data.get('toTimes', [])),
+                        data.get('runTime'),
+                        data.get('radius'),
+                        existing_ad[0]
+                    ))
+                    refresh_ad_in_index(existing_ad[0])
+                return existing_ad[0]  # No need to insert, return the existing adId
+
+            # Insert the new ad
+            cursor = conn.execute('''
+                INSERT INTO adOrders (user, center, email, fileUploaded, fromDates, fromTimes, radius, runTime, toDates, toTimes)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (data['user'], data['center'], data['email'], data['fileUploaded'],
+                  json.dumps(data['fromDates']), json.dumps(data['fromTimes']), data['radius'], data['runTime'],
+                  json.dumps(data['toDates']), json.dumps(data['toTimes'])))
+            new_id = cursor.lastrowid
+            refresh_ad_in_index(new_id)
+            return new_id
     except sqlite3.Error as e:
         print(f"Error saving data: {e}")
         return None
-    finally:
-        conn.close()
 
 
-def pick_random_memejpg(folder_path):
+def bulk_save_adOrders_to_db(orders):
     """
-    Randomly selects a .jpg file from the specified folder.
+    Saves many ad orders in one transaction, with the same matching as save_adOrders_to_db:
+    an order with the user, center and fileUploaded of an existing ad updates it, any
+    other order is inserted.
 
-    :param folder_path: Path to the folder containing .jpg files.
-    :return: The full path to the randomly selected .jpg file, or None if no .jpg files are found.
-    """
-    try:
-        # Get a list of all .jpg files in the folder
-        jpg_files = [file for file in os.listdir(folder_path) if file.lower().endswith('.jpg')]
+    Orders are deduplicated in one pass, both against the table and within the batch,
+    where the last order with a given user, center and fileUploaded wins. Updates and
+    inserts are each written with one executemany.
 
-        if not jpg_files:
-            print("No .jpg files found in the specified folder.")
-            return None
+    Args:
+        orders: A list of dictionaries in the format of save_adOrders_to_db.
 
-        # Randomly select a .jpg file
-        random_file = random.choice(jpg_files)
-        return os.path.join(folder_path, random_file)
+    Returns:
+        One (status, adId) tuple per order, status being 'inserted', 'updated' or
+        'superseded' (a later order of the batch has the same key).
+    """
+    last = {}  # key -> index of the order that wins
+    for i, data in enumerate(orders):
+        last[(data['user'], data['center'], data['fileUploaded'])] = i
+    # The winning orders as adOrders rows, time frame lists stored as JSON like save_adOrders_to_db does
+    dumped = {}  # Placements often share their time frames, each distinct list is encoded once
+    rows = {}
+    for key, i in last.items():
+        row = rows[key] = dict(orders[i])
+        for name in ('fromDates', 'fromTimes', 'toDates', 'toTimes'):
+            values = tuple(row[name])
+            if values not in dumped:
+                dumped[values] = json.dumps(row[name])
+            row[name] = dumped[values]
+
+    with transaction(DB_FILE, immediate=True) as conn:
+        existing = {(user, center, fileUploaded): (adId, email) for adId, user, center, fileUploaded, email in
+                    conn.execute('SELECT adId, user, center, fileUploaded, email FROM adOrders')}
+        inserts = [key for key in rows if key not in existing]
+
+        conn.executemany('''
+            UPDATE adOrders
+            SET fromDates = ?, fromTimes = ?, toDates = ?, toTimes = ?, runTime = ?, radius = ?
+            WHERE adId = ?
+        ''', [(row['fromDates'], row['fromTimes'], row['toDates'], row['toTimes'], row['runTime'], row['radius'],
+               existing[key][0]) for key, row in rows.items() if key in existing])
+
+        conn.executemany('''
+            INSERT INTO adOrders (user, center, email, fileUploaded, fromDates, fromTimes, radius, runTime, toDates, toTimes)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(row['user'], row['center'], row['email'], row['fileUploaded'], row['fromDates'], row['fromTimes'],
+               row['radius'], row['runTime'], row['toDates'], row['toTimes']) for row in map(rows.get, inserts)])
+        # The batch holds the write lock and adId is AUTOINCREMENT, so the new ids are contiguous
+        first_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0] - len(inserts) + 1
+
+    for key, row in rows.items():
+        if key in existing:
+            row['adId'], row['email'] = existing[key]  # Updates keep the stored email
+    for offset, key in enumerate(inserts):
+        rows[key]['adId'] = first_id + offset
+    index_adOrders_rows(rows.values())
+
+    results = []
+    for i, data in enumerate(orders):
+        key = (data['user'], data['center'], data['fileUploaded'])
+        if last[key] != i:
+            status = 'superseded'
+        else:
+            status = 'updated' if key in existing else 'inserted'
+        results.append((status, rows[key]['adId']))
+    return results
 
-    except Exception as e:
-        print(f"Error: {e}")
-        return None
@@ -0,0 +1,161 @@
+import heapq
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371  # Same radius as haversine_distance
+SINGLE_POINT_DISTANCE = 0.2  # Distance credited to a route with a single point, as calculate_distances did
+
+
+def haversine_many(origin, lats, lons):
+    """
+    Haversine distances from one (latitude, longitude) point to many points.
+
+    Args:
+      origin (tuple): The (latitude, longitude) of the origin in decimal degrees.
+      lats, lons (array-like): Latitudes and longitudes of the other points in decimal degrees.
+
+    Returns:
+      numpy.ndarray: Distances in kilometers, one per point.
+    """
+    lat1, lon1 = np.radians(np.asarray(origin, dtype=np.float64))
+    lat2 = np.radians(np.asarray(lats, dtype=np.float64))
+    lon2 = np.radians(np.asarray(lons, dtype=np.float64))
+    return _haversine(lat1, lon1, lat2, lon2)
+
+
+def haversine_pairs(coords, origins):
+    """
+    Haversine distances in kilometers between every (lat, lon) of coords and the
+    (lat, lon) in the same row of origins, both (N, 2) arrays.
+    """
+    radians = np.radians(np.asarray(coords, dtype=np.float64).reshape(-1, 2))
+    origins = np.radians(np.asarray(origins, dtype=np.float64).reshape(-1, 2))
+    return _haversine(origins[:, 0], origins[:, 1], radians[:, 0], radians[:, 1])
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def segment_distances(coords):
+    """
+    Distances in kilometers between consecutive points of an (N, 2) array of (lat, lon).
+    """
+    radians = np.radians(np.asarray(coords, dtype=np.float64).reshape(-1, 2))
+    return _haversine(radians[:-1, 0], radians[:-1, 1], radians[1:, 0], radians[1:, 1])
+
+
+def route_length(coords):
+    """
+    Length of one route in kilometers, with calculate_distances' conventions: every
+    segment is rounded to 10 m before summing and a single point counts as 0.2 km.
+    """
+    if len(coords) == 1:
+        return SINGLE_POINT_DISTANCE
+    return round(float(np.round(segment_distances(coords), 2).sum()), 2)
+
+
+def route_lengths(routes):
+    """
+    route_length for many routes in one vectorized pass.
+
+    Args:
+      routes (list): (N, 2) arrays (or lists of tuples) of (lat, lon), one per route.
+
+    Returns:
+      list of floats: The length of each route in kilometers.
+    """
+    if not routes:
+        return []
+    arrays = [np.asarray(route, dtype=np.float64).reshape(-1, 2) for route in routes]
+    counts = np.array([len(route) for route in arrays])
+    segments = np.round(segment_distances(np.concatenate(arrays)), 2)
+
+    # Zero the segments joining the last point of a route to the first point of the next one
+    ends = np.cumsum(counts)[:-1] - 1
+    segments[ends[(ends >= 0) & (ends < len(segments))]] = 0
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    totals = np.add.reduceat(np.append(segments, 0), np.minimum(starts, len(segments)))
+
+    lengths = []
+    for count, total in zip(counts.tolist(), totals.tolist()):
+        if count == 1:
+            lengths.append(SINGLE_POINT_DISTANCE)
+        elif count == 0:
+            lengths.append(0)
+        else:
+            lengths.append(round(total, 2))
+    return lengths
+
+
+def _project_metres(coords):
+    """
+    Projects (lat, lon) points to (x, y) metres on a plane tangent at their first point,
+    accurate enough for the few kilometres a route spans.
+    """
+    radians = np.radians(coords)
+    origin = radians[0]
+    x = (radians[:, 1] - origin[1]) * np.cos(origin[0]) * EARTH_RADIUS_KM * 1000
+    y = (radians[:, 0] - origin[0]) * EARTH_RADIUS_KM * 1000
+    return np.column_stack((x, y))
+
+
+def _farthest_from_segment(points, start, end):
+    """
+    Index of the point strictly between start and end farthest from the segment joining
+    them, and its distance in metres.
+    """
+    inner = points[start + 1:end]
+    a, b = points[start], points[end]
+    ab = b - a
+    length2 = float(ab @ ab)
+    if length2 == 0:
+        distances = np.hypot(*(inner - a).T)
+    else:
+        t = np.clip((inner - a) @ ab / length2, 0, 1)
+        distances = np.hypot(*(inner - a - np.outer(t, ab)).T)
+    farthest = int(np.argmax(distances))
+    return start + 1 + farthest, float(distances[farthest])
+
+
+def simplify_route(coords, tolerance_m, max_points=None):
+    """
+    Douglas-Peucker simplification of a route.
+
+    Segments are split at their farthest point, largest deviation first, until every
+    dropped point is within tolerance_m metres of the simplified route or max_points
+    points are kept, so the result is the best shape that fits the budget. The first and
+    last points are always kept.
+
+    Args:
+      coords (array-like): (N, 2) array of (lat, lon) in decimal degrees.
+      tolerance_m (float): Largest distance in metres a dropped point may be from the route.
+      max_points (int): Optional upper bound on the points kept, at least 2.
+
+    Returns:
+      numpy.ndarray: Sorted indices of the points kept, index coords and its timestamps with them.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    if len(coords) <= 2:
+        return np.arange(len(coords))
+    points = _project_metres(coords)
+    limit = len(coords) if max_points is None else max(2, max_points)
+    tolerance = 0.0 if tolerance_m is None else tolerance_m
+
+    kept = [0, len(coords) - 1]
+    heap = []
+
+    def push(start, end):
+        if end - start > 1:
+            index, distance = _farthest_from_segment(points, start, end)
+            if distance > tolerance:
+                heapq.heappush(heap, (-distance, start, end, index))
+
+    push(0, len(coords) - 1)
+    while heap and len(kept) < limit:
+        _, start, end, index = heapq.heappop(heap)
+        kept.append(index)
+        push(start, index)
+        push(index, end)
+    return np.sort(np.array(kept))
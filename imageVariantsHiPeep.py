@@ -0,0 +1,117 @@
+import io
+import os
+import threading
+
+try:
+    from PIL import Image as PILImage, ImageOps
+except ImportError:  # Pillow is optional, without it cars and reports use the uploaded file itself
+    PILImage = None
+
+VARIANT_FOLDER = 'variants'  # Sub folder of a creative's folder holding its variants
+# kind -> (bounding box in pixels, JPEG quality)
+VARIANTS = {
+    'display': ((1280, 1280), 85),  # Sent to the cars
+    'thumb': ((800, 600), 80),  # Embedded at 400x300 points in the PDF reports
+}
+
+_resolved = {}  # (creative path, kind) -> path to use, saves a stat per poll
+_resolved_lock = threading.Lock()
+
+
+def is_valid_image(data):
+    """
+    True if data (the bytes of an image file) decodes as an image. Without Pillow only
+    the JPEG signature is checked.
+    """
+    if PILImage is None:
+        return data[:3] == b'\xff\xd8\xff'
+    try:
+        with PILImage.open(io.BytesIO(data)) as image:
+            image.verify()
+    except Exception:  # Pillow raises more than OSError for corrupt files
+        return False
+    return True
+
+
+def variant_path(filepath, kind):
+    folder, name = os.path.split(filepath)
+    return os.path.join(folder, VARIANT_FOLDER, f'{os.path.splitext(name)[0]}.{kind}.jpg')
+
+
+def _render(image, kind, target):
+    size, quality = VARIANTS[kind]
+    variant = image.copy()
+    variant.thumbnail(size, PILImage.LANCZOS)  # Only ever shrinks, keeping the aspect ratio
+    temp_file = f'{target}.{os.getpid()}.{threading.get_ident()}.tmp'
+    variant.save(temp_file, 'JPEG', quality=quality, optimize=True, progressive=True)
+    os.replace(temp_file, target)
+
+
+def make_variants(filepath):
+    """
+    Renders the display and thumbnail variants of an uploaded creative, once at upload
+    time, so polls and reports never resize images.
+
+    A variant that would not be smaller than the uploaded file is skipped, the upload
+    itself is used instead.
+
+    Returns:
+        {kind: path} of the variants written, empty without Pillow or for unreadable images.
+    """
+    written = {}
+    if PILImage is not None:
+        try:
+            with PILImage.open(filepath) as image:
+                image = ImageOps.exif_transpose(image).convert('RGB')
+                os.makedirs(os.path.join(os.path.dirname(filepath), VARIANT_FOLDER), exist_ok=True)
+                original_size = os.path.getsize(filepath)
+                for kind in VARIANTS:
+                    target = variant_path(filepath, kind)
+                    _render(image, kind, target)
+                    if os.path.getsize(target) >= original_size:
+                        os.remove(target)
+                    else:
+                        written[kind] = target
+        except OSError as e:
+            print(f"Error creating variants of {filepath}: {e}")
+    with _resolved_lock:
+        for kind in VARIANTS:
+            _resolved.pop((filepath, kind), None)
+    return written
+
+
+def resolve_variant(filepath, kind):
+    """
+    Returns the path of a creative's variant, or of the creative itself when it has none.
+    """
+    key = (filepath, kind)
+    with _resolved_lock:
+        resolved = _resolved.get(key)
+    if resolved is None:
+        target = variant_path(filepath, kind)
+        resolved = target if os.path.exists(target) else filepath
+        with _resolved_lock:
+            _resolved[key] = resolved
+    return resolved
+
+
+def display_image(filepath):
+    return resolve_variant(filepath, 'display')
+
+
+def thumbnail_image(filepath):
+    return resolve_variant(filepath, 'thumb')
+
+
+def build_missing_variants(filepaths):
+    """
+    Renders the variants of creatives uploaded before variants existed.
+
+    Returns:
+        The number of creatives that got variants.
+    """
+    built = 0
+    for filepath in filepaths:
+        if all(not os.path.exists(variant_path(filepath, kind)) for kind in VARIANTS) and make_variants(filepath):
+            built += 1
+    return built
@@ -0,0 +1,310 @@
+import atexit
+import sqlite3
+import threading
+import time
+
+from dbHiPeep import DB_FILE, get_connection, release_connection, transaction
+from metricsHiPeep import COUNT_BUCKETS, metrics
+from rollupHiPeep import ensure_rollup_tables, measure_routes, write_rollups
+from geoHiPeep import simplify_route
+from routeCodecHiPeep import encode_locs, encode_times, ensure_trackerLog_schema, parse_route, route_span
+
+MAX_BATCH = 500  # Flush as soon as this many tracker rows are buffered
+MAX_DELAY = 1.0  # Flush at least this often (seconds), the loss window on a crash
+MAX_PENDING = 10000  # Producers block once this many rows are waiting, bounding memory and loss
+
+INSERT_TRACKER_LOG = '''INSERT INTO trackerLog (carId, adId, startedAt, endedAt, locs, times) VALUES (?, ?, ?, ?, ?, ?)'''
+INSERT_TRACKER_ROUTE = '''INSERT INTO trackerLog (carId, adId, startedAt, endedAt, locsBlob, timesBlob, points)
+                          VALUES (?, ?, ?, ?, ?, ?, ?)'''
+UPDATE_RUNTIME = '''UPDATE adOrders SET runTime = ? WHERE adId = ?'''
+
+
+def _is_id(value):
+    return isinstance(value, (str, int, float)) and not isinstance(value, bool)
+
+
+def _is_text(value):
+    return value is None or isinstance(value, str)
+
+
+class TrackerIngestQueue:
+    """
+    Buffers trackerLog payloads and adOrders.runTime updates in memory and writes them
+    from a background thread with executemany, one group commit per batch.
+
+    A batch is flushed when MAX_BATCH rows are waiting or MAX_DELAY seconds have passed,
+    whichever comes first. Routes are stored in the compact locsBlob/timesBlob encoding,
+    payloads that can't be encoded keep the text columns, together with their
+    startedAt/endedAt placed by the time they were submitted. Every batch also updates the
+    route/ad/car rollups in the same transaction. runTime updates are coalesced per adId
+    (the last value wins), since each one overwrites the previous. With flush_on_shutdown the remaining buffer is
+    written on stop() and at interpreter exit, otherwise at most max_delay seconds /
+    max_pending rows can be lost on shutdown.
+
+    Payloads with fields of the wrong type are rejected by submit_route. A batch that still
+    fails is written again one route at a time and the routes that fail on their own are
+    dropped, so one bad payload never holds back the others. Only when the database
+    itself is unavailable (locked, busy) is the batch put back to be retried.
+
+    With simplify_tolerance_m, encoded routes are stored Douglas-Peucker simplified to that
+    many metres. Their rollups are measured on the points as reported, so distances and
+    runtimes stay exact.
+    """
+
+    def __init__(self, db_file=DB_FILE, max_batch=MAX_BATCH, max_delay=MAX_DELAY,
+                 max_pending=MAX_PENDING, flush_on_shutdown=True, simplify_tolerance_m=None):
+        self.db_file = db_file
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.flush_on_shutdown = flush_on_shutdown
+        self.simplify_tolerance_m = simplify_tolerance_m
+
+        self._routes = []  # (carId, adId, locs, times, submitted at) tuples waiting to be written
+        self._runtimes = {}  # adId -> latest runTime waiting to be written
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+
+        self._stats = {'enqueued_routes': 0, 'enqueued_runtimes': 0, 'flushed_routes': 0,
+                       'flushed_runtimes': 0, 'flushes': 0, 'failed_flushes': 0, 'rejected_routes': 0,
+                       'dropped_routes': 0, 'max_depth': 0,
+                       'simplified_points': 0, 'last_batch_size': 0, 'last_flush_seconds': 0.0,
+                       'last_flush_at': None}
+
+    def depth(self):
+        return len(self._routes) + len(self._runtimes)
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._stopping = False
+        ensure_trackerLog_schema(self.db_file)
+        ensure_rollup_tables(self.db_file)
+        self._thread = threading.Thread(target=self._run, name='trackerIngest', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self, flush=None):
+        """
+        Stops the writer thread, flushing what is left unless flush (default
+        flush_on_shutdown) is False.
+        """
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
+        atexit.unregister(self.stop)
+
+        if self.flush_on_shutdown if flush is None else flush:
+            self.flush()
+        else:
+            with self._cond:
+                self._routes, self._runtimes = [], {}
+                self._cond.notify_all()
+
+    def _wait_for_room(self):
+        while self._thread is not None and not self._stopping and self.depth() >= self.max_pending:
+            self._cond.wait(self.max_delay)
+
+    def _enqueued(self, key):
+        self._stats[key] += 1
+        self._stats['max_depth'] = max(self._stats['max_depth'], self.depth())
+        if len(self._routes) >= self.max_batch:
+            self._cond.notify_all()
+
+    def submit_route(self, carId, adId, locs, times):
+        """
+        Queues a tracker payload. carId and adId must be strings or numbers and locs and
+        times strings (or None).
+
+        Returns:
+            False if the payload was rejected for a field of the wrong type, True otherwise.
+        """
+        if not (_is_id(carId) and _is_id(adId) and _is_text(locs) and _is_text(times)):
+            print(f"Rejected tracker payload of car {carId!r}, ad {adId!r}: fields of the wrong type")
+            self._stats['rejected_routes'] += 1
+            return False
+        with self._cond:
+            self._wait_for_room()
+            self._routes.append((carId, adId, locs, times, time.strftime('%Y-%m-%d %H:%M:%S')))
+            self._enqueued('enqueued_routes')
+        return True
+
+    def submit_runtime(self, adId, runTime):
+        with self._cond:
+            self._wait_for_room()
+            self._runtimes[int(adId)] = runTime
+            self._enqueued('enqueued_runtimes')
+
+    def flush(self):
+        """
+        Writes everything buffered so far in one transaction. Safe to call from any thread.
+
+        Returns:
+            The number of tracker rows and runTime updates written.
+        """
+        with self._flush_lock:
+            with self._cond:
+                routes, runtimes = self._routes, self._runtimes
+                self._routes, self._runtimes = [], {}
+                self._cond.notify_all()
+            if not routes and not runtimes:
+                return 0
+
+            started = time.perf_counter()
+            prepared = [self._prepare(route) for route in routes]
+            try:
+                self._write(prepared, runtimes)
+            except sqlite3.OperationalError as e:
+                # The database is locked or unavailable, not the data: retry the whole batch later
+                print(f"Error flushing tracker log batch: {e}")
+                self._stats['failed_flushes'] += 1
+                self._requeue(routes, runtimes)
+                return 0
+            except Exception as e:
+                print(f"Error flushing tracker log batch, writing its routes one by one: {e}")
+                self._stats['failed_flushes'] += 1
+                written = self._write_each(routes, prepared, runtimes)
+                if written is None:
+                    return 0
+                routes, runtimes = written
+
+            elapsed = time.perf_counter() - started
+            metrics.observe('ingest.flush', elapsed)
+            metrics.observe('ingest.batch_size', len(routes) + len(runtimes), COUNT_BUCKETS)
+            self._stats['flushes'] += 1
+            self._stats['flushed_routes'] += len(routes)
+            self._stats['flushed_runtimes'] += len(runtimes)
+            self._stats['last_batch_size'] = len(routes) + len(runtimes)
+            self._stats['last_flush_seconds'] = elapsed
+            self._stats['last_flush_at'] = time.time()
+            return len(routes) + len(runtimes)
+
+    def _prepare(self, route):
+        """
+        Parses and encodes a queued route into (query, params, measured) for _write.
+        """
+        carId, adId, locs, times, submitted = route
+        try:
+            coords, seconds, blobs = parse_route(locs, times)
+        except (ValueError, TypeError, AttributeError):
+            return INSERT_TRACKER_LOG, (carId, adId, *route_span(submitted, []), locs, times), None
+        span = route_span(submitted, seconds)
+        measured = (carId, adId, span[0][:10], coords, seconds)  # Rolled up under the day it started
+        if blobs is None:
+            return INSERT_TRACKER_LOG, (carId, adId, *span, locs, times), measured
+        return INSERT_TRACKER_ROUTE, (carId, adId, *span, *self._simplified(coords, seconds, blobs)), measured
+
+    def _write(self, prepared, runtimes):
+        """
+        Writes prepared routes, their rollups and runTime updates in one transaction.
+        """
+        with transaction(self.db_file, immediate=True):
+            conn = get_connection(self.db_file)
+            measured = []
+            for query in (INSERT_TRACKER_ROUTE, INSERT_TRACKER_LOG):
+                measured += self._insert(conn, query, [(params, route_measured)
+                                                       for route_query, params, route_measured in prepared
+                                                       if route_query == query])
+            write_rollups(measure_routes(measured), self.db_file)
+            conn.executemany(UPDATE_RUNTIME, [(runTime, adId) for adId, runTime in runtimes.items()])
+
+    def _write_each(self, routes, prepared, runtimes):
+        """
+        Writes a failed batch one route per transaction, dropping the routes that fail on
+        their own. Stops and puts the rest back if the database becomes unavailable.
+
+        Returns:
+            The (routes, runtimes) written, or None if nothing could be written.
+        """
+        written_routes, written_runtimes = [], {}
+        try:
+            self._write([], runtimes)
+            written_runtimes = runtimes
+        except sqlite3.OperationalError as e:
+            print(f"Error writing runTime updates: {e}")
+            self._requeue(routes, runtimes)
+            return None
+        except Exception as e:
+            print(f"Dropped {len(runtimes)} runTime updates that can't be written: {e}")
+
+        for i, (route, route_prepared) in enumerate(zip(routes, prepared)):
+            try:
+                self._write([route_prepared], {})
+            except sqlite3.OperationalError as e:
+                print(f"Error writing tracker log route: {e}")
+                self._requeue(routes[i:], {})
+                break
+            except Exception as e:
+                print(f"Dropped tracker payload of car {route[0]!r}, ad {route[1]!r} that can't be written: {e}")
+                self._stats['dropped_routes'] += 1
+                continue
+            written_routes.append(route)
+        if not written_routes and not written_runtimes:
+            return None
+        return written_routes, written_runtimes
+
+    def _requeue(self, routes, runtimes):
+        with self._cond:
+            # Put the routes back in front, newer runTimes win over the failed ones
+            self._routes[:0] = routes
+            self._runtimes = {**runtimes, **self._runtimes}
+
+    def _simplified(self, coords, seconds, blobs):
+        """
+        The (locsBlob, timesBlob, points) to store for a route, simplified if enabled.
+        """
+        if self.simplify_tolerance_m is None or len(coords) != len(seconds):
+            return blobs
+        keep = simplify_route(coords, self.simplify_tolerance_m)
+        if len(keep) == len(coords):
+            return blobs
+        self._stats['simplified_points'] += len(coords) - len(keep)
+        return encode_locs(coords[keep]), encode_times(seconds[keep]), len(keep)
+
+    @staticmethod
+    def _insert(conn, query, rows):
+        """
+        Inserts (params, measured) rows with one executemany and returns the
+        (routeId, carId, adId, day, coords, times) tuples the rollups need.
+        """
+        if not rows:
+            return []
+        conn.executemany(query, [params for params, _ in rows])
+        # The batch holds the write lock and routeId is AUTOINCREMENT, so the new ids are contiguous
+        last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+        first_id = last_id - len(rows) + 1
+        return [(first_id + i, *measured) for i, (_, measured) in enumerate(rows) if measured is not None]
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    deadline = time.monotonic() + self.max_delay
+                    while not self._stopping and len(self._routes) < self.max_batch:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    stopping = self._stopping
+                if stopping:
+                    return
+                self.flush()
+        finally:
+            release_connection(self.db_file)
+
+    def metrics(self):
+        """
+        Returns the queue depth and flush counters as a dictionary.
+        """
+        with self._cond:
+            metrics = dict(self._stats)
+            metrics.update({'queue_depth': self.depth(), 'pending_routes': len(self._routes),
+                            'pending_runtimes': len(self._runtimes), 'running': self._thread is not None})
+        return metrics
@@ -0,0 +1,235 @@
+import bisect
+import collections
+import contextlib
+import functools
+import sys
+import threading
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets, the last bucket takes the rest
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the histograms of counts (ads scanned per poll, batch sizes)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+PROFILE_INTERVAL = 0.005  # Seconds between two stack samples of the profiler
+PROFILE_DEPTH = 20  # Innermost frames kept per sampled stack
+# Stacks whose innermost frame is one of these are idle threads (writer, pools, server loop) and not sampled
+IDLE_FRAMES = ('threading.py:wait:', 'selectors.py:select:', 'socket.py:accept:', 'queue.py:get:')
+
+
+class Histogram:
+    """
+    Counts of observed values per bucket, plus their count, sum and maximum.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, fraction):
+        """
+        Upper bound of the bucket the given quantile falls in (the maximum for the last one).
+        """
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': round(self.sum, 6), 'max': round(self.max, 6),
+                'mean': round(self.sum / self.count, 6) if self.count else 0.0,
+                'p50': self.quantile(0.50), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99),
+                'buckets': {str(bound): count for bound, count in zip(self.buckets + ('inf',), self.counts)}}
+
+
+class Metrics:
+    """
+    Thread-safe registry of timing spans, value histograms and counters.
+
+    Spans time a stage of the request (span('poll.select')) into a latency histogram of
+    the same name. Collectors are functions returning a dictionary of gauges, read when a
+    snapshot is taken (e.g. the ingest queue's or the creative cache's own statistics).
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = collections.Counter()
+        self._collectors = {}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    @contextlib.contextmanager
+    def span(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def timed(self, name):
+        """
+        Decorator timing every call of a function as the span name.
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def register_collector(self, name, collect):
+        self._collectors[name] = collect
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self.started_at = time.time()
+
+    def snapshot(self):
+        with self._lock:
+            result = {'uptime': round(time.time() - self.started_at, 3),
+                      'histograms': {name: histogram.snapshot() for name, histogram in sorted(self._histograms.items())},
+                      'counters': dict(sorted(self._counters.items()))}
+        gauges = {}
+        for name, collect in self._collectors.items():
+            try:
+                gauges[name] = collect()
+            except Exception as e:
+                gauges[name] = {'error': repr(e)}
+        result['gauges'] = gauges
+        return result
+
+    def render_text(self):
+        """
+        The snapshot in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, histogram in snapshot['histograms'].items():
+            metric = 'hipeep_' + name.replace('.', '_')
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                le = '+Inf' if bound == 'inf' else bound
+                lines.append(f'{metric}_bucket{{le="{le}"}} {cumulative}')
+            lines.append(f'{metric}_sum {histogram["sum"]}')
+            lines.append(f'{metric}_count {histogram["count"]}')
+        for name, value in snapshot['counters'].items():
+            lines.append(f'hipeep_{name.replace(".", "_")}_total {value}')
+        for group, values in snapshot['gauges'].items():
+            for name, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f'hipeep_{group}_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler that can be switched on and off in a running server.
+
+    A background thread samples the stacks of all other threads every interval seconds
+    and counts how often each function is on a stack ('inclusive') or at its top
+    ('self'). Threads waiting in IDLE_FRAMES are skipped. Sampling costs nothing while stopped.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL, depth=PROFILE_DEPTH):
+        self.interval = interval
+        self.depth = depth
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._self = collections.Counter()
+        self._inclusive = collections.Counter()
+        self._samples = 0
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval=None):
+        with self._lock:
+            if self._thread is not None:
+                return False
+            if interval:
+                self.interval = interval
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='samplingProfiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return False
+        self._stop.set()
+        thread.join()
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._self.clear()
+            self._inclusive.clear()
+            self._samples = 0
+
+    @staticmethod
+    def _label(frame):
+        code = frame.f_code
+        return f'{code.co_filename.rsplit("/", 1)[-1]}:{code.co_name}:{code.co_firstlineno}'
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, frame in frames.items():
+                    if ident == own:
+                        continue
+                    label = self._label(frame)
+                    if label.startswith(IDLE_FRAMES):
+                        continue
+                    self._samples += 1
+                    self._self[label] += 1
+                    seen = set()
+                    for _ in range(self.depth):
+                        if frame is None:
+                            break
+                        seen.add(self._label(frame))
+                        frame = frame.f_back
+                    self._inclusive.update(seen)
+
+    def report(self, top=30):
+        with self._lock:
+            return {'running': self.running, 'interval': self.interval, 'samples': self._samples,
+                    'self': self._self.most_common(top), 'inclusive': self._inclusive.most_common(top)}
+
+
+# Shared by every module of the server process
+metrics = Metrics()
+profiler = SamplingProfiler()
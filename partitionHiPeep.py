@@ -0,0 +1,198 @@
+import base64
+import datetime
+import gzip
+import json
+import os
+
+from dbHiPeep import DB_FILE, get_connection, transaction
+from routeCodecHiPeep import ensure_trackerLog_schema
+
+ARCHIVE_FOLDER = 'trackerArchive/'  # Where cold trackerLog partitions are written
+HOT_MONTHS = 3  # Months of routes, the current one included, archive_cold_partitions keeps in trackerLog
+ARCHIVE_COLUMNS = ('routeId', 'carId', 'adId', 'startedAt', 'endedAt', 'points', 'locs', 'times',
+                   'locsBlob', 'timesBlob')
+BLOB_COLUMNS = ('locsBlob', 'timesBlob')  # Written base64 encoded, JSON has no bytes
+
+PARTITIONS_TABLE = '''CREATE TABLE IF NOT EXISTS trackerPartitions (
+        path TEXT PRIMARY KEY,
+        month TEXT,
+        routes INTEGER,
+        startedAt TEXT,
+        endedAt TEXT,
+        adIds TEXT,
+        carIds TEXT,
+        archivedAt TEXT
+    )'''
+INSERT_PARTITION = '''INSERT INTO trackerPartitions (path, month, routes, startedAt, endedAt, adIds, carIds, archivedAt)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?)'''
+
+_tables_checked = set()
+
+
+def ensure_partition_table(db_file=DB_FILE):
+    if db_file in _tables_checked:
+        return
+    ensure_trackerLog_schema(db_file)
+    get_connection(db_file).execute(PARTITIONS_TABLE)
+    _tables_checked.add(db_file)
+
+
+def window_bounds(since=None, until=None):
+    """
+    Normalizes a time window to the 'YYYY-MM-DD HH:MM:SS' form of startedAt/endedAt.
+    since and until are dates, datetimes or their ISO strings, a bare date as until
+    includes that whole day. Either may be None for an open end.
+    """
+    if since is not None:
+        since = str(since).replace('T', ' ')
+    if until is not None:
+        until = str(until).replace('T', ' ')
+        if len(until) == 10:
+            until += ' 23:59:59'
+    return since, until
+
+
+def window_clause(since=None, until=None, table='trackerLog'):
+    """
+    The SQL condition (starting with ' AND', empty without a window) and its parameters
+    matching the routes whose time span overlaps the window. Routes logged before
+    startedAt/endedAt existed have no time and only match an open window.
+    """
+    since, until = window_bounds(since, until)
+    clause, params = '', []
+    if since is not None:
+        clause += f' AND {table}.endedAt >= ?'
+        params.append(since)
+    if until is not None:
+        clause += f' AND {table}.startedAt <= ?'
+        params.append(until)
+    return clause, params
+
+
+def next_month(month):
+    year, month = map(int, month.split('-'))
+    return f'{year + month // 12:04d}-{month % 12 + 1:02d}'
+
+
+def hot_partitions(db_file=DB_FILE):
+    """
+    The months still in trackerLog as {'YYYY-MM': routes}, by the month routes started in.
+    """
+    ensure_partition_table(db_file)
+    return dict(get_connection(db_file).execute(
+        '''SELECT substr(startedAt, 1, 7) AS month, COUNT(*) FROM trackerLog
+           WHERE startedAt IS NOT NULL GROUP BY month ORDER BY month'''))
+
+
+def archived_partitions(db_file=DB_FILE):
+    ensure_partition_table(db_file)
+    cursor = get_connection(db_file).execute(
+        'SELECT path, month, routes, startedAt, endedAt, archivedAt FROM trackerPartitions ORDER BY startedAt')
+    return [dict(zip(('path', 'month', 'routes', 'startedAt', 'endedAt', 'archivedAt'), row)) for row in cursor]
+
+
+def archive_partition(month, db_file=DB_FILE, folder=ARCHIVE_FOLDER, vacuum=False):
+    """
+    Moves the routes that started in a month out of trackerLog into a gzip compressed
+    JSON lines file, and records it in trackerPartitions so reports still read it.
+
+    The file is written before the routes are deleted, and only the routes written are
+    deleted, so routes arriving meanwhile stay in trackerLog for the next run. Rollups are
+    kept, totals don't change.
+
+    Args:
+        month: The 'YYYY-MM' month to archive.
+        db_file: The path to the SQLite database file.
+        folder: Where the archive file is written.
+        vacuum: Run VACUUM afterwards so the freed pages are returned to the file system.
+
+    Returns:
+        The number of routes archived.
+    """
+    ensure_partition_table(db_file)
+    conn = get_connection(db_file)
+    cursor = conn.execute(f'''SELECT {', '.join(ARCHIVE_COLUMNS)} FROM trackerLog
+                              WHERE startedAt >= ? AND startedAt < ? ORDER BY routeId''', (month, next_month(month)))
+
+    os.makedirs(folder, exist_ok=True)
+    temp_file = os.path.join(folder, f'.trackerLog-{month}.{os.getpid()}.tmp')
+    route_ids, ad_ids, car_ids = [], set(), set()
+    started_at = ended_at = None
+    with gzip.open(temp_file, 'wt', encoding='utf-8') as archive:
+        for values in cursor:
+            row = dict(zip(ARCHIVE_COLUMNS, values))
+            for column in BLOB_COLUMNS:
+                if row[column] is not None:
+                    row[column] = base64.b64encode(row[column]).decode('ascii')
+            archive.write(json.dumps(row) + '\n')
+            route_ids.append(row['routeId'])
+            ad_ids.add(str(row['adId']))
+            car_ids.add(str(row['carId']))
+            started_at = row['startedAt'] if started_at is None else min(started_at, row['startedAt'])
+            ended_at = row['endedAt'] if ended_at is None else max(ended_at, row['endedAt'])
+    if not route_ids:
+        os.remove(temp_file)
+        return 0
+
+    path = os.path.join(folder, f'trackerLog-{month}-{route_ids[0]}.jsonl.gz')
+    os.replace(temp_file, path)
+    try:
+        with transaction(db_file, immediate=True):
+            conn.execute(INSERT_PARTITION, (path, month, len(route_ids), started_at, ended_at,
+                                            json.dumps(sorted(ad_ids)), json.dumps(sorted(car_ids)),
+                                            datetime.datetime.now().isoformat(' ', 'seconds')))
+            conn.executemany('DELETE FROM trackerLog WHERE routeId = ?', [(route_id,) for route_id in route_ids])
+    except Exception:
+        os.remove(path)
+        raise
+
+    if vacuum:
+        conn.execute('VACUUM')
+    print(f'archived {len(route_ids)} trackerLog routes of {month} to {path}')
+    return len(route_ids)
+
+
+def archive_cold_partitions(hot_months=HOT_MONTHS, db_file=DB_FILE, folder=ARCHIVE_FOLDER, today=None):
+    """
+    Archives every month older than the last hot_months ones (the current month included).
+
+    Returns:
+        {'YYYY-MM': routes archived}
+    """
+    year, number = map(int, (today or datetime.date.today()).strftime('%Y-%m').split('-'))
+    number -= hot_months - 1
+    cutoff = f'{year + (number - 1) // 12:04d}-{(number - 1) % 12 + 1:02d}'
+    return {month: archive_partition(month, db_file, folder)
+            for month in hot_partitions(db_file) if month < cutoff}
+
+
+def iter_archived_rows(column, value, since=None, until=None, db_file=DB_FILE):
+    """
+    Streams the archived trackerLog rows with column ('adId' or 'carId') equal to value
+    whose time span overlaps the window. Only the archive files overlapping the window
+    and holding that ad or car are opened.
+
+    Yields:
+        Dictionaries of the ARCHIVE_COLUMNS, like the trackerLog rows they were.
+    """
+    ensure_partition_table(db_file)
+    since, until = window_bounds(since, until)
+    ids_column = {'adId': 'adIds', 'carId': 'carIds'}[column]
+    clause, params = window_clause(since, until, 'trackerPartitions')
+    partitions = get_connection(db_file).execute(
+        f'SELECT path, {ids_column} FROM trackerPartitions WHERE 1 = 1{clause} ORDER BY startedAt', params).fetchall()
+
+    value = str(value)
+    for path, ids in partitions:
+        if value not in json.loads(ids):
+            continue
+        with gzip.open(path, 'rt', encoding='utf-8') as archive:
+            for line in archive:
+                row = json.loads(line)
+                if str(row[column]) != value or (since is not None and row['endedAt'] < since) or \
+                        (until is not None and row['startedAt'] > until):
+                    continue
+                for blob_column in BLOB_COLUMNS:
+                    if row[blob_column] is not None:
+                        row[blob_column] = base64.b64decode(row[blob_column])
+                yield row
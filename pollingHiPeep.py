@@ -0,0 +1,278 @@
+import atexit
+import json
+import pprint
+
+from budgetHiPeep import BudgetEngine
+from bulkImportHiPeep import import_orders
+from creativeCacheHiPeep import CreativeCache
+from dbHiPeep import DB_FILE
+from fallbackHiPeep import (PREFETCH_ADS, PREFETCH_HORIZON, PREFETCH_STEP, FallbackPool, PrefetchPlanner,
+                            creative_reference)
+from functionsHiPeep import (active_ads_index, rotation, save_adOrders_to_db, set_ad_runtime_in_index,
+                             upcoming_ads, validAdToRun)
+from imageVariantsHiPeep import build_missing_variants, display_image, make_variants
+from ingestHiPeep import TrackerIngestQueue
+from metricsHiPeep import metrics, profiler
+
+# Shared by the Flask server (serverHiPeep) and the asyncio server (asyncServerHiPeep)
+UPLOAD_FOLDER = 'C:/Users/Vivek Reddy Gunna/adsServer/ServerCode/adFiles/'
+IMAGE_FOLDER = 'adFiles/'  # Folder containing images to send
+MEME_FOLDER = 'memeFiles/'  # Folder containing the memes sent when no ad matches
+MEME_RUNTIME = 100  # Seconds a car shows a meme for
+MEME_RADIUS = 600
+CREATIVE_CACHE_BYTES = 256 * 1024 * 1024  # Memory for pre-encoded ad and meme images
+CREATIVE_MAX_AGE = 365 * 24 * 3600  # Creatives are addressed by content hash, so they never change
+INGEST_MAX_BATCH = 500  # trackerLog rows per group commit
+INGEST_MAX_DELAY = 1.0  # Seconds a tracker payload may wait in memory before it is written
+INGEST_SIMPLIFY_M = None  # Metres routes are simplified to before they are stored, None keeps every point
+LEASE_SECONDS = 120  # Most runTime of an ad a car is handed per poll
+UPLOAD_CHUNK = 64 * 1024  # Bytes of an uploaded creative written to disk at a time
+
+# Tracker payloads and runTime updates are written in batches by a background thread
+tracker_ingest = TrackerIngestQueue(DB_FILE, max_batch=INGEST_MAX_BATCH, max_delay=INGEST_MAX_DELAY,
+                                    simplify_tolerance_m=INGEST_SIMPLIFY_M)
+
+# Ad and meme images are read and base64 encoded once, then served from memory
+creatives = CreativeCache(CREATIVE_CACHE_BYTES)
+
+# The memes of fallback polls live in memory, and every response tells the car what to prefetch
+memes = FallbackPool(MEME_RUNTIME, MEME_RADIUS)
+prefetch = PrefetchPlanner(lambda location: prefetch_ads(location), memes)
+
+# Ad runTime is leased to cars from memory, the budgets are written back through tracker_ingest
+budget = BudgetEngine(persist=tracker_ingest.submit_runtime, lease_seconds=LEASE_SECONDS)
+
+# Their own statistics show up as gauges on /metrics
+metrics.register_collector('ingest', tracker_ingest.metrics)
+metrics.register_collector('creatives', creatives.stats)
+metrics.register_collector('budget', budget.metrics)
+metrics.register_collector('rotation', rotation().stats)
+metrics.register_collector('memes', memes.stats)
+metrics.register_collector('prefetch', prefetch.stats)
+
+
+def start_services():
+    """
+    Starts the tracker writer, renders the variants that are missing, preloads the ad
+    creatives and fills the meme pool, once per serving process.
+    """
+    tracker_ingest.start()
+    # Registered after the writer's own exit hook, so the last budgets are queued before it flushes
+    atexit.register(budget.persist_now)
+    ad_images = creatives.list_images(IMAGE_FOLDER)
+    meme_images = creatives.list_images(MEME_FOLDER)
+    build_missing_variants(ad_images + meme_images)
+    load_creatives(ad_images)
+    memes.load(load_creatives(meme_images))
+
+
+def load_creatives(filepaths):
+    """
+    Loads the display variants of creatives into the creative cache, skipping unreadable ones.
+
+    Returns:
+        The cache entries of the creatives loaded.
+    """
+    loaded = []
+    for filepath in filepaths:
+        try:
+            loaded.append(creatives.get(display_image(filepath)))
+        except OSError as e:
+            print(f"Error preloading {filepath}: {e}")
+    return loaded
+
+
+def handle_poll(json_data):
+    """
+    Ingests a car's poll and picks what it shows next.
+
+    Args:
+        json_data: The JSON payload of the car (adId, carId, runTime, locs, times,
+            currentLocation and optionally imageMode).
+
+    Returns:
+        The /endpoint response dictionary.
+    """
+    carId = json_data['carId']
+
+    # the unshown part of the car's lease goes back to the ad, the index sees it right away
+    with metrics.span('poll.settle'):
+        adId = int(json_data['adId'])
+        if budget.settle(adId, carId, json_data['runTime']) is not None and budget.available(adId) > 0:
+            set_ad_runtime_in_index(adId, budget.available(adId))
+
+    # queue the route(list of (lat,long)) for table "trackerLog"
+    with metrics.span('poll.ingest_submit'):
+        tracker_ingest.submit_route(json_data['carId'], json_data['adId'], json_data['locs'], json_data['times'])
+
+    with metrics.span('poll.select'):
+        adToSend = validAdToRun(json_data['currentLocation'], lambda row: reserve_runtime(row, carId), budget_left)
+    print("sent Ad JSON data :", adToSend)
+    budget.tick()
+
+    image_by_ref = json_data.get('imageMode') == 'ref'
+    zone = rotation().zone_of(json_data['currentLocation'])
+    with metrics.span('poll.prefetch'):
+        manifest = prefetch.manifest(zone, json_data['currentLocation'])
+
+    if adToSend:
+        metrics.count('poll.ads_sent')
+        with metrics.span('poll.creative'):
+            creative = creatives.get(display_image(adToSend['fileUploaded']))
+        adToSend.update({
+            "message": "Ad sent",
+            "status": "success",
+            "center": list(map(float, list(adToSend['center'].split(',')))),
+            "runTime": int(adToSend["runTime"]),
+            "radius": int(adToSend["radius"]),
+            "prefetch": manifest})
+        adToSend.update(creative_fields(creative, image_by_ref))
+        return adToSend
+    else:
+        metrics.count('poll.memes_sent')
+        # The meme's response was prepared when the pool was loaded
+        response = memes.response(zone, json_data['currentLocation'], image_by_ref)
+        if response is None:
+            response = {"message": "No meme to send", "status": "error", "center": json_data['currentLocation'],
+                        "runTime": MEME_RUNTIME, "radius": MEME_RADIUS, "adId": 0}
+        response["prefetch"] = manifest
+        return response
+
+
+def prefetch_ads(location):
+    """
+    The (adId, creative) pairs of the ads a car at location may be sent within
+    PREFETCH_HORIZON, for its prefetch manifest.
+    """
+    ads = []
+    for row in upcoming_ads(location, PREFETCH_HORIZON, PREFETCH_STEP)[:PREFETCH_ADS]:
+        try:
+            ads.append((row['adId'], creatives.get(display_image(row['fileUploaded']))))
+        except OSError as e:
+            print(f"Error loading creative of ad {row['adId']}: {e}")
+    return ads
+
+
+def budget_left(row):
+    """
+    An ad's runTime not leased to any car, for ranking. Ads the budget engine hasn't
+    seen yet still have their stored runTime.
+    """
+    available = budget.available(row['adId'])
+    if available is None:
+        try:
+            return float(row['runTime'])
+        except (TypeError, ValueError):
+            return 0
+    return available
+
+
+def reserve_runtime(row, carId):
+    """
+    Leases runTime of an ad to a car, dropping the ad from the index once its whole
+    budget is spent.
+    """
+    granted = budget.reserve(row['adId'], carId, row['runTime'])
+    if budget.exhausted(row['adId']):
+        set_ad_runtime_in_index(int(row['adId']), 0)
+    return granted
+
+
+def creative_fields(creative, image_by_ref):
+    """
+    Returns the image part of an /endpoint response, the base64 image itself or a reference to it.
+    """
+    if image_by_ref:
+        return creative_reference(creative)
+    # Embed image as base64 string in the JSON response
+    return {"image": creative['base64']}
+
+
+def metrics_snapshot():
+    """
+    The /metrics response: spans, histograms, counters and the gauges of the services.
+    """
+    snapshot = metrics.snapshot()
+    snapshot['gauges']['index'] = {'active_ads': len(active_ads_index())}
+    snapshot['profiler'] = {'running': profiler.running}
+    return snapshot
+
+
+def profiler_command(action, interval=None):
+    """
+    Switches the sampling profiler at runtime.
+
+    Args:
+        action: 'start', 'stop', 'clear' or 'report'.
+        interval: Seconds between samples, for 'start'.
+
+    Returns:
+        The profiler report, or None for an unknown action.
+    """
+    if action == 'start':
+        profiler.start(float(interval) if interval else None)
+    elif action == 'stop':
+        profiler.stop()
+    elif action == 'clear':
+        profiler.clear()
+    elif action != 'report':
+        return None
+    return profiler.report()
+
+
+def save_ad_order(form, file_path):
+    """
+    Saves the ad order of an /submit form whose creative was written to file_path,
+    after rendering the creative's display and thumbnail variants.
+
+    Args:
+        form: The submitted form fields (any mapping, e.g. Flask's request.form).
+        file_path: Where the uploaded creative was saved.
+
+    Returns:
+        The saved order, with its adId under 'UniqueID'.
+    """
+    make_variants(file_path)
+    creatives.invalidate(file_path)
+    creatives.invalidate(display_image(file_path))
+
+    logDict = {"user": form['client'],
+               "fromDates": json.loads(form['fromDate']),
+               "fromTimes": json.loads(form['fromTime']),
+               "toDates": json.loads(form['toDate']),
+               "toTimes": json.loads(form['toTime']),
+               "center": form['center'],
+               "radius": form['radius'],
+               "runTime": form['run_time'],
+               "email": form['email'],
+               "fileUploaded": file_path}
+
+    k = save_adOrders_to_db(logDict)
+    if k is not None:
+        budget.load(k, logDict['runTime'])
+    logDict['UniqueID'] = k
+    pprint.pprint(logDict)
+    return logDict
+
+
+def save_ad_orders_bulk(data, filename, archive=None):
+    """
+    Saves the orders of a /submit/bulk upload, see bulkImportHiPeep.import_orders.
+
+    Args:
+        data: The contents of the CSV or JSONL orders file.
+        filename: The orders file's name.
+        archive: The uploaded zip/tar archive of creatives (binary file object), or None.
+
+    Returns:
+        The import summary with one result per row.
+    """
+    result = import_orders(data, filename, archive, UPLOAD_FOLDER,
+                           on_saved=lambda adId, order: budget.load(adId, order['runTime']))
+    for file_path in result['creatives']:
+        make_variants(file_path)
+        creatives.invalidate(file_path)
+        creatives.invalidate(display_image(file_path))
+    print(f"bulk import of {filename}: {result['inserted']} inserted, {result['updated']} updated, "
+          f"{result['superseded']} superseded, {result['error']} failed")
+    return result
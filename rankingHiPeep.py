@@ -0,0 +1,142 @@
+import collections
+import threading
+
+ZONE_DEGREES = 0.01  # Size of a rotation zone in degrees of latitude/longitude (about 1 km)
+MAX_WEIGHT = 4  # Turns per rotation of the best ranked ad, the worst one always gets 1
+RERANK_PICKS = 50  # Picks in a zone after which its ads are ranked again
+MAX_ZONES = 10000  # Zones whose rotation is kept, the least recently polled are dropped
+# Share of the ranking score of an ad's remaining budget, its closeness and its lack of recent exposure
+BUDGET_WEIGHT = 0.4
+DISTANCE_WEIGHT = 0.4
+EXPOSURE_WEIGHT = 0.2
+
+
+def rotation_sequence(weights):
+    """
+    Smooth weighted round robin order of the given {adId: weight} (integers >= 1): every
+    ad appears weight times, spread out as evenly as possible.
+    """
+    total = sum(weights.values())
+    current = dict.fromkeys(weights, 0)
+    sequence = []
+    for _ in range(total):
+        for adId, weight in weights.items():
+            current[adId] += weight
+        best = max(current, key=lambda adId: (current[adId], -adId))
+        current[best] -= total
+        sequence.append(best)
+    return sequence
+
+
+class ZoneRotation:
+    """
+    Fair rotation of the eligible ads per zone.
+
+    Each zone keeps a precomputed weighted rotation of the ads eligible there, so a pick
+    is a cursor step. The weights come from ranking the ads by remaining budget,
+    closeness to their center and how often they were shown in the zone recently. A
+    zone is ranked again when its set of eligible ads changes or after RERANK_PICKS picks.
+    """
+
+    def __init__(self, zone_degrees=ZONE_DEGREES, max_weight=MAX_WEIGHT, rerank_picks=RERANK_PICKS,
+                 max_zones=MAX_ZONES):
+        self.zone_degrees = zone_degrees
+        self.max_weight = max_weight
+        self.rerank_picks = rerank_picks
+        self.max_zones = max_zones
+        self._zones = collections.OrderedDict()  # zone -> rotation state, least recently polled first
+        self._lock = threading.Lock()
+
+    def zone_of(self, location):
+        lat, lon = map(float, location)
+        return int(lat // self.zone_degrees), int(lon // self.zone_degrees)
+
+    def rank(self, eligible, exposure):
+        """
+        Weights of the eligible ads of a zone.
+
+        Args:
+            eligible: {adId: (remaining budget, distance / radius)}.
+            exposure: {adId: recent picks in the zone}.
+
+        Returns:
+            {adId: weight}, weights between 1 and max_weight.
+        """
+        most_budget = max(budget for budget, _ in eligible.values()) or 1
+        total_exposure = sum(exposure.get(adId, 0) for adId in eligible) or 1
+        weights = {}
+        for adId, (budget, distance) in eligible.items():
+            score = (BUDGET_WEIGHT * budget / most_budget +
+                     DISTANCE_WEIGHT * (1 - min(distance, 1)) +
+                     EXPOSURE_WEIGHT * (1 - exposure.get(adId, 0) / total_exposure))
+            weights[adId] = 1 + round(score * (self.max_weight - 1))
+        return weights
+
+    def _state_locked(self, zone, eligible):
+        state = self._zones.get(zone)
+        if state is None:
+            state = self._zones[zone] = {'ads': None, 'sequence': [], 'cursor': 0, 'picks': 0,
+                                         'exposure': collections.Counter()}
+            if len(self._zones) > self.max_zones:
+                self._zones.popitem(last=False)
+        else:
+            self._zones.move_to_end(zone)
+
+        ads = frozenset(eligible)
+        if state['ads'] != ads or state['picks'] >= self.rerank_picks:
+            exposure = state['exposure']
+            state['sequence'] = rotation_sequence(self.rank(eligible, exposure))
+            state['cursor'] %= len(state['sequence'])
+            state['ads'] = ads
+            state['picks'] = 0
+            # Older exposure counts for half at every ranking
+            state['exposure'] = collections.Counter({adId: count // 2 for adId, count in exposure.items()
+                                                     if adId in ads and count > 1})
+        return state
+
+    def order(self, location, eligible):
+        """
+        The eligible ads in the order they should be tried for a car at location, the
+        zone's next turn first. Every ad appears once.
+        """
+        if not eligible:
+            return []
+        with self._lock:
+            state = self._state_locked(self.zone_of(location), eligible)
+            sequence, cursor = state['sequence'], state['cursor']
+        seen = set()
+        ordered = []
+        for i in range(len(sequence)):
+            adId = sequence[(cursor + i) % len(sequence)]
+            if adId not in seen:
+                seen.add(adId)
+                ordered.append(adId)
+                if len(ordered) == len(eligible):
+                    break
+        return ordered
+
+    def shown(self, location, adId):
+        """
+        Records that an ad was handed out in the zone of location and moves the zone's
+        rotation past its turn.
+        """
+        with self._lock:
+            state = self._zones.get(self.zone_of(location))
+            if state is None or not state['sequence']:
+                return
+            sequence = state['sequence']
+            for i in range(len(sequence)):
+                position = (state['cursor'] + i) % len(sequence)
+                if sequence[position] == adId:
+                    state['cursor'] = (position + 1) % len(sequence)
+                    break
+            state['picks'] += 1
+            state['exposure'][adId] += 1
+
+    def clear(self):
+        with self._lock:
+            self._zones.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'zones': len(self._zones)}
@@ -0,0 +1,118 @@
+import concurrent.futures
+import datetime
+import os
+import uuid
+
+from reportsHiPeep import (ad_report_data, build_ad_report_pdf, generate_report_for_carId,
+                           render_route_plot, route_plot_tasks)
+
+REPORTS_FOLDER = 'reports/'  # Every job writes into its own sub folder of this one
+
+
+def print_progress(done, total, label):
+    print(f'[{done}/{total}] {label}')
+
+
+def _init_worker():
+    # Worker processes only ever render to files
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def new_job_folder(reports_folder=REPORTS_FOLDER):
+    """
+    Creates a unique folder for the PDFs of one report job.
+    """
+    job_id = f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}"
+    job_folder = os.path.join(reports_folder, job_id)
+    os.makedirs(job_folder)
+    return job_id, job_folder
+
+
+def run_report_job(ad_ids=(), car_ids=(), workers=None, progress=print_progress, reports_folder=REPORTS_FOLDER,
+                   since=None, until=None):
+    """
+    Generates the reports of many ads and cars in one job, rendering the route plots and
+    building the PDFs in a process pool.
+
+    The route data of every ad is read up front, all route plots are rendered in parallel
+    and an ad's PDF is built as soon as its last plot is done. Plots and PDFs that are
+    already in the artifact cache are reused instead of rendered. The PDFs go to a unique
+    job folder, so concurrent jobs never overwrite each other.
+
+    Args:
+        ad_ids: The adIds to build ad reports for.
+        car_ids: The carIds to build car reports for.
+        workers: Number of worker processes, defaults to the number of CPUs.
+        progress: Called as progress(done, total, label) after every finished task, or None.
+        reports_folder: The folder the job folder is created in.
+        since, until: Optional time window, only the routes overlapping it are reported.
+
+    Returns:
+        A dictionary with the jobId, the job folder, the PDF of every ad and car
+        ({'ads': {adId: path}, 'cars': {carId: path}}) and the errors by task.
+    """
+    job_id, job_folder = new_job_folder(reports_folder)
+    result = {'jobId': job_id, 'folder': job_folder, 'ads': {}, 'cars': {}, 'errors': {}}
+
+    reports = {}
+    for adId in ad_ids:
+        try:
+            reports[adId] = ad_report_data(adId, since, until)
+        except Exception as e:
+            result['errors'][f'ad {adId}'] = repr(e)
+
+    plot_tasks = {adId: route_plot_tasks(data) for adId, data in reports.items()}
+    total = sum(len(tasks) for tasks in plot_tasks.values()) + len(reports) + len(car_ids)
+    done = 0
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        pending = {}  # future -> (kind, key)
+        plots = {adId: {} for adId in plot_tasks}  # adId -> {route_id: cached plot image}
+        plots_left = {}
+
+        def submit_pdf(adId):
+            output_file = os.path.join(job_folder, f'ad_{adId}.pdf')
+            pending[pool.submit(build_ad_report_pdf, reports[adId], plots[adId], output_file)] = ('ad', adId)
+
+        for adId, tasks in plot_tasks.items():
+            plots_left[adId] = len(tasks)
+            for route_id, task in tasks.items():
+                pending[pool.submit(render_route_plot, *task)] = ('plot', (adId, route_id))
+            if not tasks:
+                submit_pdf(adId)
+
+        for carId in car_ids:
+            output_file = os.path.join(job_folder, f'car_{carId}.pdf')
+            pending[pool.submit(generate_report_for_carId, carId, output_file, since, until)] = ('car', carId)
+
+        while pending:
+            finished, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                kind, key = pending.pop(future)
+                done += 1
+                error = future.exception()
+                if kind == 'plot':
+                    adId, route_id = key
+                    label = f'ad {adId} route {route_id}'
+                    if error is not None:
+                        result['errors'][label] = repr(error)
+                    else:
+                        plots[adId][route_id] = future.result()
+                    plots_left[adId] -= 1
+                    if plots_left[adId] == 0:
+                        if any(name.startswith(f'ad {adId} ') for name in result['errors']):
+                            done += 1  # The PDF of an ad with a failed plot is skipped
+                            result['errors'][f'ad {adId}'] = 'route plot failed'
+                        else:
+                            submit_pdf(adId)
+                else:
+                    label = f'{kind} {key}'
+                    if error is not None:
+                        result['errors'][label] = repr(error)
+                    else:
+                        result[f'{kind}s'][key] = future.result()
+                if progress is not None:
+                    progress(done, total, label)
+
+    return result
@@ -0,0 +1,292 @@
+import os
+import shutil
+
+import matplotlib.pyplot as plt
+from matplotlib.patches import Circle
+from reportlab.lib.pagesizes import letter
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image
+from reportlab.lib.styles import getSampleStyleSheet
+import numpy as np
+
+from artifactCacheHiPeep import artifact_key, artifacts, file_digest
+from dbHiPeep import DB_FILE
+from exposureHiPeep import exposure_totals, route_exposure
+from functionsHiPeep import fetch_row_as_dict, route_log_by_adId, route_log_by_carId
+from geoHiPeep import simplify_route
+from imageVariantsHiPeep import thumbnail_image
+from metricsHiPeep import metrics
+from partitionHiPeep import window_bounds
+from routeCodecHiPeep import format_times
+
+PLOT_DPI = 300  # Resolution of the rendered route graphs, part of their cache key
+REPORT_TOLERANCE_M = 10  # Routes are simplified to this many metres in the report plots and listings
+REPORT_MAX_POINTS = 250  # Most points of a route plotted and listed, whatever its length
+
+
+def simplify_for_report(logs, exposures=None):
+    """
+    Simplifies streamed route logs for the plots and listings of a report, so their size
+    and render time stay bounded however long the routes are. Distances, runtimes and
+    exposures are kept as measured on every point.
+
+    Args:
+        logs: (route_id, details) pairs with every point.
+        exposures: Optional {route_id: exposure} of route_exposure, added to the details.
+
+    Returns:
+        {route_id: details}, details holding the kept 'locs' and 'times', the route's
+        original number of 'points' and its 'exposure' (None without one).
+    """
+    exposures = exposures or {}
+    simplified = {}
+    for route_id, details in logs:
+        locs, times = details['locs'], details['times']
+        keep = simplify_route(locs, REPORT_TOLERANCE_M, REPORT_MAX_POINTS)
+        if len(keep) < len(locs):
+            if len(times) == len(locs):
+                times = [times[i] for i in keep] if isinstance(times, list) else times[keep]
+            locs = locs[keep]
+        simplified[route_id] = dict(details, locs=locs, times=times, points=len(details['locs']),
+                                    exposure=exposures.get(route_id))
+    return simplified
+
+
+def points_label(details):
+    if len(details['locs']) < details['points']:
+        return f"Coordinates ({len(details['locs'])} of {details['points']} points)"
+    return "Coordinates"
+
+
+def period_label(period):
+    since, until = period
+    if since is None and until is None:
+        return ''
+    return f"<br/>Period: {since or 'start'} to {until or 'now'}"
+
+
+def exposure_label(exposure):
+    """
+    The in-zone time, distance and entries of a route or campaign, as a paragraph line.
+    """
+    if exposure is None:
+        return ''
+    return f"<br/>In Zone: {exposure['inZoneSeconds']} seconds, {exposure['inZoneDistance']} km, " \
+           f"{exposure['entries']} entries, {exposure['exits']} exits"
+
+
+def format_coordinates(coordinates):
+    return str([tuple(point) for point in coordinates.tolist()])
+
+
+def format_timestamps(times):
+    if isinstance(times, list):
+        return str(times)  # Raw strings of a route whose times weren't HH:MM:SS
+    return str(format_times(times))
+
+
+def save_plot_as_image(list_of_tuples_of_xys, center, radius, file_name):
+    """
+    Saves the route graph as an image file with accurate rendering.
+    """
+    x_values, y_values = zip(*list_of_tuples_of_xys)
+
+    # Create the figure and axis
+    plt.figure()  # Start a new figure
+    plt.plot(x_values, y_values, marker='*')  # Plot points and line
+
+    plt.xlabel('Latitude')
+    plt.ylabel('Longitude')
+    plt.grid(True)
+
+    # Create the circle object
+    circle = Circle(xy=center, radius=radius * 0.01, color='grey', fill=False)
+
+    # Add the circle to the plot
+    ax = plt.gca()  # Get the current axis
+    ax.add_patch(circle)
+
+    # Highlight the center of the circle
+    plt.scatter(center[0], center[1], color='red', s=100)  # Center marker
+
+    # Ensure equal aspect ratio
+    ax.set_aspect("equal")
+
+    # Save the plot as an image
+    plt.savefig(file_name, format='png', dpi=PLOT_DPI)  # Save with high resolution
+    plt.close()  # Close the plot to avoid overlap
+
+
+@metrics.timed('report.ad_data')
+def ad_report_data(adId, since=None, until=None):
+    """
+    Collects everything an ad report needs: its route logs, totals, exposure in its zone,
+    poster and zone, optionally only for the routes overlapping the since/until window.
+    """
+    logs, total_distance, total_runtime, poster = route_log_by_adId(adId, since, until)
+    adData = fetch_row_as_dict(DB_FILE, 'adOrders', 'adId', adId)
+    center, radius = tuple(map(float, adData['center'].split(','))), int(adData['radius'])
+    exposures = route_exposure(logs, {adId: (center, radius)})
+    return {'adId': adId,
+            'period': window_bounds(since, until),
+            'logs': simplify_for_report(logs.items(), exposures),
+            'total_distance': total_distance,
+            'total_runtime': total_runtime,
+            'exposure': exposure_totals(exposures.values()),
+            'poster': poster,
+            'center': center,
+            'radius': radius}
+
+
+def route_plot_tasks(report_data):
+    """
+    Returns the render_route_plot arguments of every route in an ad report, as a
+    {route_id: (locs, center, radius)} dictionary.
+    """
+    return {route_id: (details['locs'], report_data['center'], report_data['radius'])
+            for route_id, details in report_data['logs'].items()}
+
+
+@metrics.timed('report.route_plot')
+def render_route_plot(list_of_tuples_of_xys, center, radius):
+    """
+    Returns the route graph image of a route from the artifact cache, rendering it with
+    save_plot_as_image only if this route, zone and PLOT_DPI haven't been rendered before.
+    """
+    key = artifact_key('route-plot', PLOT_DPI, np.asarray(list_of_tuples_of_xys, dtype=np.float64),
+                       tuple(center), radius)
+    return artifacts.get_or_create(
+        key, 'png', lambda path: save_plot_as_image(list_of_tuples_of_xys, center, radius, path))
+
+
+def copy_cached_report(key, output_file, write_pdf):
+    """
+    Copies the cached PDF with the given key to output_file, building it with
+    write_pdf(path) first if it isn't cached.
+    """
+    shutil.copyfile(artifacts.get_or_create(key, 'pdf', write_pdf), output_file)
+    print(f"PDF report generated")
+    return output_file
+
+
+@metrics.timed('report.ad_pdf')
+def build_ad_report_pdf(report_data, plots, output_file='adReportFile.pdf'):
+    """
+    Builds the PDF of an ad report from its data and the already rendered route plots.
+    The PDF is reused from the artifact cache when the routes, totals and poster are unchanged.
+
+    Args:
+        report_data: The dictionary returned by ad_report_data.
+        plots: A dictionary of route_id -> rendered route graph image.
+        output_file: Where to write the PDF.
+    """
+    key = artifact_key('ad-report', {k: v for k, v in report_data.items() if k != 'poster'},
+                       file_digest(thumbnail_image(report_data['poster'])),
+                       {route_id: os.path.basename(plot) for route_id, plot in plots.items()})
+    return copy_cached_report(key, output_file, lambda path: write_ad_report_pdf(report_data, plots, path))
+
+
+def write_ad_report_pdf(report_data, plots, output_file):
+    doc = SimpleDocTemplate(output_file, pagesize=letter)
+    styles = getSampleStyleSheet()
+
+    elements = [Paragraph("Route Logs Report", styles['Title']), Spacer(1, 12)]
+
+    # Add summary
+    summary = f"Total Distance: {report_data['total_distance']} km<br/>" \
+              f"Total Runtime: {report_data['total_runtime']} seconds" \
+              f"{exposure_label(report_data['exposure'])}{period_label(report_data['period'])}"
+    elements.append(Paragraph(summary, styles['Normal']))
+    elements.append(Spacer(1, 12))
+    elements.append(Image(thumbnail_image(report_data['poster']), width=400, height=300))
+
+    # Add route details
+    for route_id, details in report_data['logs'].items():
+        elements.append(Paragraph(f"Route ID: {route_id}", styles['Heading2']))
+        elements.append(Paragraph(f"car ID: {details['carId']}", styles['Normal']))
+        elements.append(Paragraph(f"Distance: {details['distance']} km", styles['Normal']))
+        elements.append(Paragraph(f"Runtime: {details['runtime']} seconds{exposure_label(details['exposure'])}",
+                                  styles['Normal']))
+        elements.append(Paragraph(f"{points_label(details)}: {format_coordinates(details['locs'])}",
+                                  styles['Normal']))
+        elements.append(Paragraph(f"Timestamps: {format_timestamps(details['times'])}", styles['Normal']))
+
+        # Add route graph
+        elements.append(Image(plots[route_id], width=400, height=300))
+        elements.append(Spacer(1, 12))
+
+    # Build the PDF
+    doc.build(elements)
+
+
+def generate_report_for_adId(adId, output_file='adReportFile.pdf', since=None, until=None):
+    """
+    Creates a PDF report with route logs, distances, and graphs, of the routes overlapping
+    the since/until window if one is given.
+    Route graphs are rendered one after the other, see reportJobsHiPeep for the parallel version.
+    """
+
+    report_data = ad_report_data(adId, since, until)
+    plots = {}
+    for route_id, task in route_plot_tasks(report_data).items():
+        plots[route_id] = render_route_plot(*task)
+        print(route_id)
+
+    return build_ad_report_pdf(report_data, plots, output_file)
+
+
+@metrics.timed('report.car_pdf')
+def generate_report_for_carId(carId, output_file='carReportFile.pdf', since=None, until=None):
+    """
+    Creates a PDF report with route logs, distances, and graphs, of the routes overlapping
+    the since/until window if one is given.
+    """
+
+    logs, total_distance, total_runtime = route_log_by_carId(carId, since, until)
+    exposures = route_exposure(logs)
+    logs = simplify_for_report(logs.items(), exposures)
+    exposure = exposure_totals(exposures.values())
+    period = window_bounds(since, until)
+
+    posters = sorted({details['poster'] for details in logs.values()} - {None})
+    key = artifact_key('car-report', carId, period, logs, total_distance, total_runtime,
+                       [file_digest(thumbnail_image(poster)) for poster in posters])
+    return copy_cached_report(
+        key, output_file,
+        lambda path: write_car_report_pdf(carId, logs, total_distance, total_runtime, path, period, exposure))
+
+
+def write_car_report_pdf(carId, logs, total_distance, total_runtime, output_file, period=(None, None),
+                         exposure=None):
+    doc = SimpleDocTemplate(output_file, pagesize=letter)
+    styles = getSampleStyleSheet()
+
+    elements = []
+
+    # Add Title
+    elements.append(Paragraph(f"{carId} Log Report", styles['Title']))
+    elements.append(Spacer(1, 12))
+
+    # Add summary
+    summary = f"Total Distance: {total_distance} km<br/>Total Runtime: {total_runtime} seconds" \
+              f"{exposure_label(exposure)}{period_label(period)}"
+    elements.append(Paragraph(summary, styles['Normal']))
+    elements.append(Spacer(1, 12))
+
+    # Add route details
+    for route_id, details in logs.items():
+        elements.append(Paragraph(f"Route ID: {route_id}", styles['Heading2']))
+        elements.append(Paragraph(f"Distance: {details['distance']} km", styles['Normal']))
+        elements.append(Paragraph(f"Runtime: {details['runtime']} seconds{exposure_label(details['exposure'])}",
+                                  styles['Normal']))
+        elements.append(Paragraph(f"{points_label(details)}: {format_coordinates(details['locs'])}",
+                                  styles['Normal']))
+        elements.append(Paragraph(f"Timestamps: {format_timestamps(details['times'])}", styles['Normal']))
+
+        # Add the poster, routes that ran a meme or a deleted ad have none
+        poster = details['poster']
+        if poster is not None:
+            elements.append(Image(thumbnail_image(poster), width=400, height=300))
+        elements.append(Spacer(1, 12))
+
+    # Build the PDF
+    doc.build(elements)
@@ -0,0 +1,184 @@
+from dbHiPeep import DB_FILE, get_connection, rows_as_dicts, transaction
+from geoHiPeep import route_lengths
+from routeCodecHiPeep import ensure_trackerLog_schema, route_arrays
+
+SECONDS_PER_POINT = 30  # A car reports its location every 30 seconds, the runtime convention of the reports
+BACKFILL_DAY = 'unknown'  # Day of the routes logged before rollups existed, they carry no date
+BACKFILL_CHUNK = 1000  # trackerLog rows measured per vectorized batch when rebuilding
+
+ROLLUP_TABLES = (
+    '''CREATE TABLE IF NOT EXISTS routeRollup (
+            routeId INTEGER PRIMARY KEY,
+            carId,
+            adId INTEGER,
+            day TEXT,
+            distance REAL,
+            runtime INTEGER,
+            points INTEGER
+        )''',
+    '''CREATE TABLE IF NOT EXISTS adDailyRollup (
+            adId INTEGER,
+            day TEXT,
+            distance REAL,
+            runtime INTEGER,
+            points INTEGER,
+            routes INTEGER,
+            PRIMARY KEY (adId, day)
+        )''',
+    '''CREATE TABLE IF NOT EXISTS carDailyRollup (
+            carId,
+            day TEXT,
+            distance REAL,
+            runtime INTEGER,
+            points INTEGER,
+            routes INTEGER,
+            PRIMARY KEY (carId, day)
+        )''',
+)
+
+INSERT_ROUTE_ROLLUP = '''INSERT OR REPLACE INTO routeRollup (routeId, carId, adId, day, distance, runtime, points)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)'''
+UPSERT_DAILY_ROLLUP = '''INSERT INTO {table} ({key}, day, distance, runtime, points, routes) VALUES (?, ?, ?, ?, ?, ?)
+                         ON CONFLICT ({key}, day) DO UPDATE SET
+                            distance = distance + excluded.distance,
+                            runtime = runtime + excluded.runtime,
+                            points = points + excluded.points,
+                            routes = routes + excluded.routes'''
+
+_tables_checked = set()
+
+
+def ensure_rollup_tables(db_file=DB_FILE):
+    if db_file in _tables_checked:
+        return
+    conn = get_connection(db_file)
+    for statement in ROLLUP_TABLES:
+        conn.execute(statement)
+    _tables_checked.add(db_file)
+
+
+def measure_routes(routes):
+    """
+    Computes the rollup row of many routes in one vectorized pass.
+
+    Args:
+        routes: (routeId, carId, adId, day, coords, times) tuples, coords being an (N, 2) array.
+
+    Returns:
+        A list of (routeId, carId, adId, day, distance, runtime, points) tuples, one per route
+        with at least one point.
+    """
+    routes = [route for route in routes if len(route[4]) != 0]
+    distances = route_lengths([route[4] for route in routes])
+    return [(routeId, carId, adId, day, distance, len(times) * SECONDS_PER_POINT, len(coords))
+            for (routeId, carId, adId, day, coords, times), distance in zip(routes, distances)]
+
+
+def _daily(rollups, key_index):
+    daily = {}
+    for rollup in rollups:
+        key = (rollup[key_index], rollup[3])
+        distance, runtime, points, routes = daily.get(key, (0, 0, 0, 0))
+        daily[key] = (distance + rollup[4], runtime + rollup[5], points + rollup[6], routes + 1)
+    return [(*key, *totals) for key, totals in daily.items()]
+
+
+def write_rollups(rollups, db_file=DB_FILE):
+    """
+    Adds measured routes to the route, ad-per-day and car-per-day rollups. Runs in the
+    caller's transaction, so the rollups commit together with the trackerLog rows.
+    """
+    if not rollups:
+        return
+    conn = get_connection(db_file)
+    conn.executemany(INSERT_ROUTE_ROLLUP, rollups)
+    conn.executemany(UPSERT_DAILY_ROLLUP.format(table='adDailyRollup', key='adId'), _daily(rollups, 2))
+    conn.executemany(UPSERT_DAILY_ROLLUP.format(table='carDailyRollup', key='carId'), _daily(rollups, 1))
+
+
+def rebuild_rollups(db_file=DB_FILE):
+    """
+    Recomputes the rollups of the routes in trackerLog, for databases that predate them or
+    after trackerLog was edited by hand, then the daily rollups from all route rollups.
+    A route keeps the day of its existing rollup, or else takes the day it started, routes
+    without either count under BACKFILL_DAY. Routes stored simplified (fewer
+    points than their rollup counted) and archived routes keep their rollup, it was
+    measured on the points as reported.
+
+    Returns:
+        The number of routes rolled up.
+    """
+    ensure_trackerLog_schema(db_file)
+    ensure_rollup_tables(db_file)
+    conn = get_connection(db_file)
+    total = 0
+    with transaction(db_file, immediate=True):
+        simplified = {row[0]: row for row in conn.execute(
+            '''SELECT routeRollup.* FROM routeRollup JOIN trackerLog ON trackerLog.routeId = routeRollup.routeId
+               WHERE trackerLog.points < routeRollup.points''')}
+        days = dict(conn.execute(f'''SELECT routeId, day FROM routeRollup WHERE day != '{BACKFILL_DAY}'
+                                     AND routeId IN (SELECT routeId FROM trackerLog)'''))
+        conn.execute('DELETE FROM routeRollup WHERE routeId IN (SELECT routeId FROM trackerLog)')
+
+        rows = rows_as_dicts(conn.execute('SELECT * FROM trackerLog ORDER BY routeId'))
+        chunk = []
+        for row in rows:
+            if row['routeId'] in simplified:
+                continue
+            try:
+                coords, times = route_arrays(row)
+            except ValueError:
+                continue  # Stored as text because its points can't be parsed, ingest rolls it up neither
+            day = days.get(row['routeId']) or (row.get('startedAt') or '')[:10] or BACKFILL_DAY
+            chunk.append((row['routeId'], row['carId'], row['adId'], day, coords, times))
+            if len(chunk) == BACKFILL_CHUNK:
+                rollups = measure_routes(chunk)
+                conn.executemany(INSERT_ROUTE_ROLLUP, rollups)
+                total += len(rollups)
+                chunk = []
+        rollups = measure_routes(chunk) + list(simplified.values())
+        conn.executemany(INSERT_ROUTE_ROLLUP, rollups)
+        total += len(rollups)
+
+        for table, key in (('adDailyRollup', 'adId'), ('carDailyRollup', 'carId')):
+            conn.execute(f'DELETE FROM {table}')
+            conn.execute(f'''INSERT INTO {table} ({key}, day, distance, runtime, points, routes)
+                             SELECT {key}, day, SUM(distance), SUM(runtime), SUM(points), COUNT(*)
+                             FROM routeRollup GROUP BY {key}, day''')
+    print(f'rolled up {total} trackerLog routes')
+    return total
+
+
+def _totals(table, key, value, from_day, to_day, db_file):
+    ensure_rollup_tables(db_file)
+    query = f'SELECT SUM(distance), SUM(runtime), SUM(points), SUM(routes) FROM {table} WHERE {key} = ?'
+    params = [value]
+    if from_day is not None:
+        query += ' AND day >= ?'
+        params.append(from_day)
+    if to_day is not None:
+        query += ' AND day <= ?'
+        params.append(to_day)
+    distance, runtime, points, routes = get_connection(db_file).execute(query, params).fetchone()
+    return {'distance': round(distance or 0, 2), 'runtime': runtime or 0, 'points': points or 0, 'routes': routes or 0}
+
+
+def ad_totals(adId, from_day=None, to_day=None, db_file=DB_FILE):
+    """
+    Total distance (km), runtime (seconds), points and routes of an ad, optionally
+    between two 'YYYY-MM-DD' days (inclusive), read from adDailyRollup.
+    """
+    return _totals('adDailyRollup', 'adId', adId, from_day, to_day, db_file)
+
+
+def car_totals(carId, from_day=None, to_day=None, db_file=DB_FILE):
+    """
+    Same as ad_totals, for a car, read from carDailyRollup.
+    """
+    return _totals('carDailyRollup', 'carId', carId, from_day, to_day, db_file)
+
+
+def route_rollup(routeId, db_file=DB_FILE):
+    ensure_rollup_tables(db_file)
+    cursor = get_connection(db_file).execute('SELECT * FROM routeRollup WHERE routeId = ?', (routeId,))
+    return next(rows_as_dicts(cursor), None)
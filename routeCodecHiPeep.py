@@ -0,0 +1,226 @@
+import datetime
+import zlib
+
+import numpy as np
+
+from dbHiPeep import DB_FILE, get_connection, transaction
+
+LOCS_FORMAT = 1  # int32 micro-degrees delta-encoded per lat/lon column, zlib compressed
+TIMES_FORMAT = 1  # Delta-encoded int32 seconds of the day, zlib compressed
+COORD_SCALE = 1e6  # Fixed-point scale of the stored coordinates, ~0.1 m resolution
+CLOCK_SKEW = 3600  # Seconds a car's clock may run ahead of the server's
+SECONDS_PER_DAY = 24 * 3600
+
+# 'YYYY-MM-DD HH:MM:SS' start and end of a route, the time window queries and partitions go by
+ROUTE_COLUMNS = {'locsBlob': 'BLOB', 'timesBlob': 'BLOB', 'points': 'INTEGER', 'startedAt': 'TEXT', 'endedAt': 'TEXT'}
+ROUTE_INDEXES = {'idx_trackerLog_carId': 'carId, routeId', 'idx_trackerLog_adId': 'adId, routeId',
+                 'idx_trackerLog_carId_startedAt': 'carId, startedAt', 'idx_trackerLog_adId_startedAt': 'adId, startedAt',
+                 'idx_trackerLog_startedAt': 'startedAt'}
+
+_schema_checked = set()  # Database files whose trackerLog schema is known to be current
+
+
+def parse_locs_text(locs):
+    """
+    Parses the legacy 'lat:lon*lat:lon*' string into an (N, 2) float64 array.
+    """
+    pairs = [pair for pair in (locs or '').rstrip('*').split('*') if pair]
+    if not pairs:
+        return np.empty((0, 2))
+    return np.array(':'.join(pairs).split(':'), dtype=np.float64).reshape(-1, 2)
+
+
+def parse_times_text(times):
+    """
+    Parses the legacy 'HH:MM:SS*HH:MM:SS*' string into an int32 array of seconds of the day.
+    Raises ValueError if a timestamp is not in HH:MM:SS form.
+    """
+    stamps = [stamp for stamp in (times or '').rstrip('*').split('*') if stamp]
+    parts = np.array(':'.join(stamps).split(':') if stamps else [], dtype=np.int64)
+    if parts.size != 3 * len(stamps):
+        raise ValueError(f"times are not in HH:MM:SS form: {times[:40]!r}")
+    parts = parts.reshape(-1, 3)
+    return (parts[:, 0] * 3600 + parts[:, 1] * 60 + parts[:, 2]).astype(np.int32)
+
+
+def format_times(seconds):
+    """
+    Formats seconds of the day back into the 'HH:MM:SS' strings the reports print.
+    """
+    return [f'{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}' for s in np.asarray(seconds).tolist()]
+
+
+def route_span(submitted, seconds):
+    """
+    Returns the (startedAt, endedAt) of a route submitted at submitted ('YYYY-MM-DD HH:MM:SS')
+    from its seconds of the day. The last timestamp is the latest time of the day at most
+    CLOCK_SKEW after the submission, so a route sent just after midnight ended the day
+    before. A route whose last timestamp is before its first one started the day before
+    it ended. Routes without HH:MM:SS timestamps span the whole day they were submitted.
+    """
+    day = submitted[:10]
+    if isinstance(seconds, list) or len(seconds) == 0:
+        return f'{day} 00:00:00', f'{day} 23:59:59'
+    submitted_at = datetime.datetime.fromisoformat(submitted)
+    ended_at = datetime.datetime.fromisoformat(day) + datetime.timedelta(seconds=int(seconds[-1]))
+    if ended_at > submitted_at + datetime.timedelta(seconds=CLOCK_SKEW):
+        ended_at -= datetime.timedelta(days=1)
+    started_at = ended_at - datetime.timedelta(seconds=int(seconds[-1] - seconds[0]) % SECONDS_PER_DAY)
+    return started_at.isoformat(' '), ended_at.isoformat(' ')
+
+
+def _pack(values, fmt):
+    # values is 1-D, or (N, 2) for points, whose deltas are taken along each column
+    deltas = np.diff(values, axis=0, prepend=0).astype('<i4')
+    return bytes([fmt]) + zlib.compress(deltas.tobytes())
+
+
+def _unpack(blob, fmt):
+    if not blob:
+        return np.empty(0, dtype='<i4')
+    if blob[0] != fmt:
+        raise ValueError(f"unknown route encoding {blob[0]}")
+    return np.frombuffer(zlib.decompress(blob[1:]), dtype='<i4')
+
+
+def encode_locs(coords):
+    """
+    Encodes an (N, 2) array of (lat, lon) into a BLOB of fixed-point integers, each
+    column delta-encoded so consecutive points store small steps.
+    """
+    fixed = np.rint(np.asarray(coords, dtype=np.float64).reshape(-1, 2) * COORD_SCALE).astype(np.int64)
+    return _pack(fixed, LOCS_FORMAT)
+
+
+def decode_locs(blob):
+    """
+    Decodes a locsBlob straight into an (N, 2) float64 array of (lat, lon).
+    """
+    return np.cumsum(_unpack(blob, LOCS_FORMAT).reshape(-1, 2), axis=0, dtype=np.int64) / COORD_SCALE
+
+
+def encode_times(seconds):
+    return _pack(np.asarray(seconds, dtype=np.int64), TIMES_FORMAT)
+
+
+def decode_times(blob):
+    return np.cumsum(_unpack(blob, TIMES_FORMAT), dtype=np.int64).astype(np.int32)
+
+
+def encode_route(locs, times):
+    """
+    Encodes the legacy locs/times strings of a tracker payload.
+
+    Returns:
+        (locsBlob, timesBlob, points), or None if the payload can't be encoded and
+        has to be stored as text.
+    """
+    try:
+        coords = parse_locs_text(locs)
+        seconds = parse_times_text(times)
+    except (ValueError, TypeError, AttributeError):
+        return None
+    return encode_locs(coords), encode_times(seconds), len(coords)
+
+
+def parse_route(locs, times):
+    """
+    Parses the legacy locs/times strings of a tracker payload once, for both storing and measuring it.
+
+    Returns:
+        (coords, times, encoded): the (N, 2) points, the seconds of the day (or the raw
+        strings when they aren't HH:MM:SS) and the (locsBlob, timesBlob, points) to store,
+        which is None when the payload has to be stored as text.
+        Raises ValueError if the points themselves can't be parsed.
+    """
+    coords, seconds = route_arrays({'locs': locs, 'times': times})
+    if isinstance(seconds, list):
+        return coords, seconds, None
+    return coords, seconds, (encode_locs(coords), encode_times(seconds), len(coords))
+
+
+def route_arrays(row):
+    """
+    Returns the points of a trackerLog row as an (N, 2) array and its timestamps as an
+    array of seconds of the day, reading the compact columns when present.
+    Timestamps that are not HH:MM:SS come back as the list of raw strings.
+    """
+    if row.get('locsBlob') is not None:
+        return decode_locs(row['locsBlob']), decode_times(row['timesBlob'])
+
+    coords = parse_locs_text(row.get('locs'))
+    try:
+        seconds = parse_times_text(row.get('times'))
+    except ValueError:
+        seconds = (row.get('times') or '').rstrip('*').split('*')
+    return coords, seconds
+
+
+def ensure_route_columns(db_file=DB_FILE):
+    """
+    Adds the compact route columns to trackerLog if the database predates them.
+    """
+    conn = get_connection(db_file)
+    existing = {column[1] for column in conn.execute('PRAGMA table_info(trackerLog)')}
+    for name, sql_type in ROUTE_COLUMNS.items():
+        if name not in existing:
+            conn.execute(f'ALTER TABLE trackerLog ADD COLUMN {name} {sql_type}')
+
+
+def ensure_trackerLog_schema(db_file=DB_FILE):
+    """
+    Brings trackerLog up to date (compact route and time columns, carId/adId and time
+    window indexes), once per database file and process.
+    """
+    if db_file in _schema_checked:
+        return
+    ensure_route_columns(db_file)
+    conn = get_connection(db_file)
+    for name, columns in ROUTE_INDEXES.items():
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON trackerLog ({columns})')
+    _schema_checked.add(db_file)
+
+
+def migrate_trackerLog_routes(db_file=DB_FILE, drop_text=True, batch_size=1000, vacuum=False):
+    """
+    Re-encodes existing trackerLog rows into the compact locsBlob/timesBlob columns.
+
+    Args:
+        db_file: The path to the SQLite database file.
+        drop_text: Clear the legacy locs/times text of every migrated row.
+        batch_size: Rows re-encoded per transaction.
+        vacuum: Run VACUUM afterwards so the freed pages are returned to the file system.
+
+    Returns:
+        The number of rows migrated. Rows whose text can't be parsed are left as they are.
+    """
+    ensure_trackerLog_schema(db_file)
+    conn = get_connection(db_file)
+    migrated = 0
+    last_id = -1
+    while True:
+        rows = conn.execute('''SELECT routeId, locs, times FROM trackerLog
+                               WHERE routeId > ? AND locsBlob IS NULL ORDER BY routeId LIMIT ?''',
+                            (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        updates = []
+        for route_id, locs, times in rows:
+            encoded = encode_route(locs, times)
+            if encoded is not None:
+                updates.append((*encoded, route_id))
+        with transaction(db_file):
+            if drop_text:
+                conn.executemany('''UPDATE trackerLog SET locsBlob = ?, timesBlob = ?, points = ?,
+                                    locs = NULL, times = NULL WHERE routeId = ?''', updates)
+            else:
+                conn.executemany('''UPDATE trackerLog SET locsBlob = ?, timesBlob = ?, points = ?
+                                    WHERE routeId = ?''', updates)
+        migrated += len(updates)
+
+    if vacuum:
+        conn.execute('VACUUM')
+    print(f'migrated {migrated} trackerLog routes to the compact encoding')
+    return migrated
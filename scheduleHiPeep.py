@@ -0,0 +1,148 @@
+import bisect
+import datetime
+import functools
+import math
+import threading
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_ONE_DAY = datetime.timedelta(days=1)
+COMPILED_CACHE_SIZE = 4096  # Distinct time frame sets kept compiled, bulk placements often share one
+
+
+def to_epoch_seconds(moment=None):
+    """
+    Converts a naive local datetime (or None for now) to seconds since 1970-01-01.
+    Numbers are passed through unchanged so callers can mix datetimes and epoch seconds.
+    """
+    if moment is None:
+        moment = datetime.datetime.now()
+    if isinstance(moment, (int, float)):
+        return float(moment)
+    return (moment - _EPOCH).total_seconds()
+
+
+def compile_time_frames(time_frames):
+    """
+    Compiles the fromDates/fromTimes/toDates/toTimes lists of an ad into sorted,
+    merged (start, stop) epoch-second intervals.
+
+    A time frame is live on every day between its from and to date, between its from
+    and to time (both inclusive), which is what is_within_valid_time_frames always checked.
+    Intervals are half-open, stop is the first instant after the to time.
+
+    Returns:
+        A tuple (starts, stops) of equally long sorted lists of floats. Identical time
+        frames share the same lists, which must not be modified.
+    """
+    return _compile_frames(tuple(tuple(time_frames[name]) for name in ('fromDates', 'fromTimes', 'toDates', 'toTimes')))
+
+
+@functools.lru_cache(maxsize=COMPILED_CACHE_SIZE)
+def _compile_frames(frames):
+    fromDates, fromTimes, toDates, toTimes = frames
+    intervals = []
+    for i in range(len(fromDates)):
+        from_date = datetime.datetime.strptime(fromDates[i], '%Y-%m-%d')
+        from_time = datetime.datetime.strptime(fromTimes[i], '%H:%M')
+        to_date = datetime.datetime.strptime(toDates[i], '%Y-%m-%d')
+        to_time = datetime.datetime.strptime(toTimes[i], '%H:%M')
+
+        start_offset = from_time.hour * 3600 + from_time.minute * 60
+        end_offset = to_time.hour * 3600 + to_time.minute * 60
+        if start_offset > end_offset:
+            continue  # The daily window is empty, the ad never runs in this frame
+
+        day = from_date
+        while day <= to_date:
+            day_start = to_epoch_seconds(day)
+            intervals.append((day_start + start_offset, math.nextafter(day_start + end_offset, math.inf)))
+            day += _ONE_DAY
+
+    intervals.sort()
+    starts, stops = [], []
+    for start, stop in intervals:
+        if stops and start <= stops[-1]:
+            stops[-1] = max(stops[-1], stop)
+        else:
+            starts.append(start)
+            stops.append(stop)
+    return starts, stops
+
+
+class CompiledSchedule:
+    """
+    The live intervals of a single campaign, answering point queries with a binary search.
+    """
+
+    def __init__(self, starts, stops):
+        self.starts = starts
+        self.stops = stops
+
+    @classmethod
+    def from_time_frames(cls, time_frames):
+        return cls(*compile_time_frames(time_frames))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def contains(self, moment=None):
+        t = to_epoch_seconds(moment)
+        i = bisect.bisect_right(self.starts, t) - 1
+        return i >= 0 and t < self.stops[i]
+
+    def contains_many(self, moments):
+        return [self.contains(moment) for moment in moments]
+
+
+class ScheduleEngine:
+    """
+    The compiled schedules of all active campaigns, by adId.
+
+    Callers only ever ask about the few ads the spatial index returns for a location, so
+    each ad is checked with a binary search over its own intervals, and adding, replacing
+    or removing an ad only touches that ad.
+    """
+
+    def __init__(self):
+        self._schedules = {}  # adId -> CompiledSchedule
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._schedules)
+
+    def set_schedule(self, adId, time_frames):
+        """
+        Compiles and stores an ad's time frames. Returns the CompiledSchedule, or None if
+        the time frames could not be parsed (the ad is then dropped from the engine).
+        """
+        try:
+            schedule = CompiledSchedule.from_time_frames(time_frames)
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Error compiling schedule of ad {adId}: {e}")
+            self.remove(adId)
+            return None
+
+        with self._lock:
+            self._schedules[int(adId)] = schedule
+        return schedule
+
+    def remove(self, adId):
+        with self._lock:
+            self._schedules.pop(int(adId), None)
+
+    def clear(self):
+        with self._lock:
+            self._schedules.clear()
+
+    def get(self, adId):
+        return self._schedules.get(int(adId))
+
+    def is_live(self, adId, moment=None):
+        schedule = self._schedules.get(int(adId))
+        return schedule is not None and schedule.contains(moment)
+
+    def is_live_many(self, adId, moments):
+        schedule = self._schedules.get(int(adId))
+        if schedule is None:
+            return [False] * len(moments)
+        return schedule.contains_many(moments)
@@ -1,61 +1,86 @@
+import io
 import json
 import os
-import pprint
 
-from flask import Flask, request, jsonify, send_file, render_template
-from sandboxServerFunctions import *
+from flask import Flask, Response, request, jsonify, send_file, render_template
+from dbHiPeep import release_connection
+from metricsHiPeep import metrics
+from pollingHiPeep import (CREATIVE_MAX_AGE, UPLOAD_CHUNK, UPLOAD_FOLDER, creatives, handle_poll, metrics_snapshot,
+                           profiler_command, save_ad_order, save_ad_orders_bulk, start_services)
 
 app = Flask(__name__)
 
 
+@app.teardown_appcontext
+def return_db_connection(exception=None):
+    # Hand the request thread's pooled connection back for the next request
+    release_connection()
+
+
 @app.route('/')
 def home():
     return render_template('client.html')
 
 
 # Configure the upload folder
-UPLOAD_FOLDER = 'C:/Users/Vivek Reddy Gunna/adsServer/ServerCode/adFiles/'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
 SERVER_IP = '127.0.0.1'  # Loopback address for local testing
 SERVER_PORT = 5004
 BUFFER_SIZE = 4096
-IMAGE_FOLDER = 'adFiles/'  # Folder containing images to send
 SENDING_INTERVAL = 30  # Interval between sending images (3 minutes = 180 seconds)
 
+start_services()
+
 
 @app.route('/submit', methods=['POST', 'GET'])
+@metrics.timed('submit.total')
 def preview():
     file = request.files['adName']  # Access the file by its name in the form
 
     if file:
         filename = file.filename
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
-
-        logDict = {"user": request.form['client'],
-                   "fromDates": json.loads(request.form['fromDate']),
-                   "fromTimes": json.loads(request.form['fromTime']),
-                   "toDates": json.loads(request.form['toDate']),
-                   "toTimes": json.loads(request.form['toTime']),
-                   "center": request.form['center'],
-                   "radius": request.form['radius'],
-                   "runTime": request.form['run_time'],
-                   "email": request.form['email'],
-                   "fileUploaded": file_path}
-
-        k = save_adOrders_to_db(logDict)
-        logDict['UniqueID'] = k
-        pprint.pprint(logDict)
+        with metrics.span('submit.save_file'):
+            # Streamed to disk in chunks, an existing creative is only replaced once the upload is complete
+            file.save(file_path + '.part', buffer_size=UPLOAD_CHUNK)
+            os.replace(file_path + '.part', file_path)
+        with metrics.span('submit.save_order'):
+            save_ad_order(request.form, file_path)
         return "success"
     else:
         return 'No file uploaded'
 
 
+@app.route('/submit/bulk', methods=['POST'])
+@metrics.timed('submit.bulk')
+def bulk_submit():
+    """
+    Saves many ad orders at once: a CSV or JSONL file of orders in 'orders' and
+    optionally a zip/tar archive of their creatives in 'creatives'. Answers with the
+    per-row results.
+    """
+    if 'orders' not in request.files:
+        return jsonify({"error": "No orders file in the request"}), 400
+
+    orders = request.files['orders']
+    archive = request.files.get('creatives')
+    try:
+        return jsonify(save_ad_orders_bulk(orders.read(), orders.filename or '',
+                                           archive.stream if archive else None))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+
 @app.route('/endpoint', methods=['POST'])
+@metrics.timed('endpoint.total')
 def handle_request():
     """
     Endpoint to handle JSON file uploads and send responses.
+
+    By default the image is embedded as a base64 string. Clients that send
+    "imageMode": "ref" in their JSON instead get the image's content hash in "imageHash"
+    and its /creative URL in "imageUrl", and only download it when they don't have it yet.
     """
     if 'file' not in request.files:
         return jsonify({"error": "No file part in the request"}), 400
@@ -66,52 +91,52 @@ def handle_request():
         return jsonify({"error": "Uploaded file is not a JSON file"}), 400
 
     try:
-        json_data = json.loads(file.read().decode('utf-8'))
+        with metrics.span('endpoint.parse'):
+            json_data = json.loads(file.read().decode('utf-8'))
         print("Received Client JSON data :", json_data['adId'])
     except json.JSONDecodeError:
         return jsonify({"error": "Invalid JSON file"}), 400
 
-    # update sql database table "adsInQueue" with left over runtimes
-    update_sql('mooh.db', 'adOrders', 'adId', int(json_data['adId']), 'runTime', json_data['runTime'])
-
-    # update sql database table "tracker_log" with routes(list of (lat,long))
-    conn = sqlite3.connect('mooh.db')
-    cursor = conn.cursor()
-    cursor.execute('''INSERT INTO trackerLog (carId, adId, locs, times) VALUES (?, ?, ?, ?)''',
-                   (json_data['carId'], json_data['adId'], json_data['locs'], json_data['times']))
-    conn.commit()
-    conn.close()
-
-    adToSend = validAdToRun(json_data['currentLocation'])
-    print("sent Ad JSON data :", adToSend)
-
-    if adToSend:
-        # Embed image as base64 string in the JSON response
-        image_base64 = encode_image_to_base64(adToSend['fileUploaded'])
-        adToSend.update({
-            "message": "Ad sent",
-            "status": "success",
-            "center": list(map(float, list(adToSend['center'].split(',')))),
-            "runTime": int(adToSend["runTime"]),
-            "radius": int(adToSend["radius"]),
-            "image": image_base64})
-        # update sql database table "adsInQueue" with left over runtimes
-        update_sql('mooh.db', 'adOrders', 'adId', int(adToSend['adId']), 'runTime', 0)
-
-        return jsonify(adToSend)
-    else:
-        # Embed image as base64 string in the JSON response
-        # image_base64 = encode_image_to_base64(f'C:/Users/Vivek Reddy Gunna/adsServer/ServerCode/meme.jpg')
-        image_base64 = encode_image_to_base64(pick_random_memejpg("C:/Users/Vivek Reddy Gunna/adsServer/"
-                                                                  "ServerCode/memeFiles"))
-        return jsonify({
-            "message": "Meme Sent",
-            "status": "success",
-            "center": json_data['currentLocation'],
-            "runTime": 100,
-            "radius": 600,
-            "adId": 0,
-            "image": image_base64})
+    with metrics.span('endpoint.handle_poll'):
+        response = handle_poll(json_data)
+    with metrics.span('endpoint.serialize'):
+        return jsonify(response)
+
+
+@app.route('/creative/<etag>', methods=['GET'])
+def creative(etag):
+    """
+    Streams the raw bytes of a creative by its content hash, answering If-None-Match
+    with 304 and Range requests with partial content.
+    """
+    entry = creatives.get_by_etag(etag)
+    if entry is None:
+        return jsonify({"error": "Unknown creative"}), 404
+
+    return send_file(io.BytesIO(entry['data']), mimetype='image/jpeg', etag=etag,
+                     conditional=True, max_age=CREATIVE_MAX_AGE)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Timing histograms, counters and service gauges as JSON, or in the Prometheus text
+    format with ?format=text.
+    """
+    if request.args.get('format') == 'text':
+        return Response(metrics.render_text(), mimetype='text/plain')
+    return jsonify(metrics_snapshot())
+
+
+@app.route('/metrics/profiler', methods=['GET', 'POST'])
+def profiler_endpoint():
+    """
+    Sampling profiler switch: ?action=start|stop|clear|report (and &interval=seconds to start).
+    """
+    report = profiler_command(request.args.get('action', 'report'), request.args.get('interval'))
+    if report is None:
+        return jsonify({"error": "Unknown profiler action"}), 400
+    return jsonify(report)
 
 
 if __name__ == '__main__':